@@ -4,17 +4,36 @@ Command-line wrapper tool to execute parallel runs of FreeSurfer recon-all and s
 This file can also be imported as a module and contains the following functions:
 
     * argument_parser -  parser for command-line options, arguments and sub-commands.
+    * parse_timeouts - parses the --timeout values.
+    * sweep_ratios - returns the gcut_sweep --ratios values.
+    * sweep_cache - returns the path of the gcut_sweep cache file.
+    * copy_files - copies files (recon_edit masks).
+    * build_pipeline_jobs - creates the dependency graph of the pipeline sub-command.
+    * build_jobs - creates the list of jobs for the selected sub-command.
     * run_command - select and run the commands
-    * worker - invokes a subprocess running the command.
 
 """
 
 import argparse
 import multiprocessing as mp
-import subprocess
+import os
+import shutil
 import sys
+import time
+from functools import partial
 import pandas as pd
 
+from scripts.gcut_sweep import DEFAULT_RATIOS, merge_cache, summarize_sweep, sweep_jobs
+from scripts.history import RuntimeModel, collect_history, read_history, results_to_records, update_history
+from scripts.journal import Journal, prepare_resume, read_journal
+from scripts.manifest import read_tasks, task_argv, task_name
+from scripts.planner import plan_jobs, print_plan
+from scripts.resources import DEFAULT_COSTS, ResourceBudget, read_costs
+from scripts.scheduler import Job, Scheduler, write_report
+from scripts.scratch import Scratch
+from scripts.status import TAIL_BYTES, ReconAllLogReader, print_status, status_report
+from scripts.work_queue import WorkQueue, run_worker
+
 
 def argument_parser(args: list) -> "ArgumentParser.parse_args":
     """
@@ -34,105 +53,364 @@ def argument_parser(args: list) -> "ArgumentParser.parse_args":
     parser = argparse.ArgumentParser(description="Command-line wrapper tool to execute parallel runs of FreeSurfer recon-all and some pial edits algorithms.")
     subparsers = parser.add_subparsers(dest="command")
 
-    recon = subparsers.add_parser('recon_all', help='Run FreeSurfer recon-all [CROSS].')
+    # Options shared by every sub-command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-p', '--parallel', type=int, help='Number of parallel runs (default: number of CPUs).', default=mp.cpu_count())
+    common.add_argument('-r', '--retries', type=int, help='Number of times a failed job is started again (default: 0).', default=0)
+    common.add_argument('--backoff', type=float, help='Seconds to wait before the first retry of a job, doubled for every further retry (default: 60).', default=60)
+    common.add_argument('--timeout', type=str, action='append', help='Wall time limit in hours of a job, for all stages (e.g. 24) or a single stage (e.g. recon_all=12). Can be repeated.', default=None)
+    common.add_argument('--stall', type=float, help='Stop a recon-all job when its recon-all.log has no new lines for STALL minutes.', default=None)
+    common.add_argument('--report', type=str, help='Path to write a JSON report with the exit status and timing of each job.', default=None)
+    common.add_argument('--memory', type=float, help='Memory budget in MB for all running jobs (default: memory available at start).', default=None)
+    common.add_argument('--openmp', type=int, help='Maximum number of threads given to a recon-all job (-openmp) when the queue drains (default: 1).', default=1)
+    common.add_argument('--costs', type=str, help='Tab separated file with the memory (MB) and threads used by each command. Required columns: command, memory, threads.', default=None)
+    common.add_argument('--history', type=str, help='Tab separated file where the wall time of each job is stored (default: runtime_history.tsv).', default='runtime_history.tsv')
+    common.add_argument('--journal', type=str, help='Path to the JSON lines journal of job states (default: <input>_journal.jsonl).', default=None)
+    common.add_argument('--resume', action='store_true', help='Resume an interrupted run: skip jobs done according to the journal and restart interrupted or failed jobs from scratch.')
+    common.add_argument('--order', type=str, choices=['longest', 'input'], help='Dispatch order: longest predicted jobs first, or input file order (default: longest).', default='longest')
+    common.add_argument('--queue', type=str, help='Shared queue directory: jobs are run by "run.py worker" processes on other nodes instead of locally, -p is the number of jobs queued at the same time.', default=None)
+    common.add_argument('--lease', type=float, help='Seconds without heartbeat after which the attempt of a job claimed by a worker fails and is retried as any failed attempt (used with --queue, default: 600).', default=600)
+    common.add_argument('--logs', type=str, help='Directory where the output of each job is written to <LOGS>/<stage>/<name>.log.gz instead of the terminal; the last lines are printed when a job fails (default: logs).', default='logs')
+    common.add_argument('--plan', action='store_true', help='Dry run: print the number of jobs to run and already done, the estimated CPU-hours and wall time for -p, and the critical path, without running anything.')
+    common.add_argument('--scratch', type=str, help='Node-local scratch directory: recon-all [CROSS], [BASE] and [LONG] jobs run there and their subject folder is moved to SUBJECTS_DIR when they finish.', default=None)
+
+    recon = subparsers.add_parser('recon_all', parents=[common], help='Run FreeSurfer recon-all [CROSS].')
     recon.add_argument('-i', '--input', type=str, help='Tab separated file. Required columns: id (unique ID), dcm_path (path to dcm/nii file).', required=True)
-    recon.add_argument('-p', '--parallel', type=int, help='Number of parallel runs (default: number of CPUs).', default=mp.cpu_count())
    
-    recon_base = subparsers.add_parser('recon_base', help='Run FreeSurfer recon-all [BASE].')
-    recon_base.add_argument('-i', '--input', type=str, help='Path to recon_base_input.txt file used for base processing. Each line must be a command "recon-all -base <subject> -tp <unique_id> -tp <unique_id> ... -all"', required=True)
-    recon_base.add_argument('-p', '--parallel', type=int, help='Number of parallel runs (default: number of CPUs).', default=mp.cpu_count())
+    recon_base = subparsers.add_parser('recon_base', parents=[common], help='Run FreeSurfer recon-all [BASE].')
+    recon_base.add_argument('-i', '--input', type=str, help='Path to recon_base_input.txt file used for base processing, where each line is a command "recon-all -base <subject> -tp <unique_id> -tp <unique_id> ... -all", or to a manifest (.tsv/.json) with columns stage, subject, id, timepoints, flags.', required=True)
     
-    recon_long = subparsers.add_parser('recon_long', help='Run FreeSurfer recon-all [LONG].')
-    recon_long.add_argument('-i', '--input', type=str, help='Path to recon_long_input.txt file used for long processing. Each line must be a command "recon-all -long <unique_id> <subject> -all', required=True)
-    recon_long.add_argument('-p', '--parallel', type=int, help='Number of parallel runs (default: number of CPUs).', default=mp.cpu_count())
+    recon_long = subparsers.add_parser('recon_long', parents=[common], help='Run FreeSurfer recon-all [LONG].')
+    recon_long.add_argument('-i', '--input', type=str, help='Path to recon_long_input.txt file used for long processing, where each line is a command "recon-all -long <unique_id> <subject> -all", or to a manifest (.tsv/.json) with columns stage, subject, id, timepoints, flags.', required=True)
    
-    segHA = subparsers.add_parser('segment_HA', help='Run [CROSS] segmentation of hippocampal subfields and nuclei of the amygdala.')
+    segHA = subparsers.add_parser('segment_HA', parents=[common], help='Run [CROSS] segmentation of hippocampal subfields and nuclei of the amygdala.')
     segHA.add_argument('-i', '--input', type=str, help='Tab separated file. Required columns: id (unique ID) from subject processed with recon-all [CROSS]', required=True)
-    segHA.add_argument('-p', '--parallel', type=int, help='Number of parallel FS runs (default: number of CPUs).', default=mp.cpu_count())
     
-    segHA_long = subparsers.add_parser('segment_HA_long', help='Run [LONG] segmentation of hippocampal subfields and nuclei of the amygdala.')
+    segHA_long = subparsers.add_parser('segment_HA_long', parents=[common], help='Run [LONG] segmentation of hippocampal subfields and nuclei of the amygdala.')
     segHA_long.add_argument('-i', '--input', type=str, help='Tab separated file. Required columns: subject (base ID) from subject processed with recon-all [BASE])', required=True)
-    segHA_long.add_argument('-p', '--parallel', type=int, help='Number of parallel FS runs (default: number of CPUs).', default=mp.cpu_count())
     
-    edit = subparsers.add_parser('edit', help='Run mri_gcut and mri_binarize for pial edits.')
-    edit.add_argument('-i', '--input', type=str, help='Tab separated file. Required columns column: id (unique ID) from subject processed with recon-all [CROSS], ratio: threshold to value (%) of WM intensity.', required=True)
-    edit.add_argument('-p', '--parallel', type=int, help='Number of parallel FS runs (default: number of CPUs).', default=mp.cpu_count())
+    edit = subparsers.add_parser('edit', parents=[common], help='Run mri_gcut and mri_binarize for pial edits.')
+    edit.add_argument('-i', '--input', type=str, help='Tab separated file. Required columns column: id (unique ID) from subject processed with recon-all [CROSS], ratio: threshold to value (%%) of WM intensity.', required=True)
     
-    recon_edit = subparsers.add_parser('recon_edit', help='Re-run recon-all for pial edits.')
+    recon_edit = subparsers.add_parser('recon_edit', parents=[common], help='Re-run recon-all for pial edits.')
     recon_edit.add_argument('-i', '--input', type=str, help='Subject id list file.', required=True)
-    recon_edit.add_argument('-p', '--parallel', type=int, help='Number of parallel FS runs (default: number of CPUs).', default=mp.cpu_count())
+
+    gcut_sweep = subparsers.add_parser('gcut_sweep', parents=[common], help='Run mri_gcut with several tissue ratios per subject and recommend a ratio for edit and recon_edit.')
+    gcut_sweep.add_argument('-i', '--input', type=str, help='Tab separated file. Required column: id (unique ID) from subject processed with recon-all [CROSS].', required=True)
+    gcut_sweep.add_argument('--ratios', type=str, help=f'Comma separated tissue ratios to evaluate (default: {",".join(DEFAULT_RATIOS)}).', default=",".join(DEFAULT_RATIOS))
+    gcut_sweep.add_argument('--max-removed', type=float, help='Maximum fraction of the brainmask.auto.mgz voxels removed by the recommended ratio (default: 0.05).', default=0.05)
+    gcut_sweep.add_argument('--cache', type=str, help='JSON file caching the mask metrics of each subject and ratio (default: <input>_gcut_sweep.json).', default=None)
+    gcut_sweep.add_argument('-o', '--output', type=str, help='Tab separated output file: input columns, recommended ratio and removed fraction per ratio (default: <input>_gcut_sweep.tsv).', default=None)
+
+    history = subparsers.add_parser('history', help='Record the wall time of finished recon-all runs found in SUBJECTS_DIR into the history file.')
+    history.add_argument('--history', type=str, help='Tab separated history file (default: runtime_history.tsv).', default='runtime_history.tsv')
+
+    status = subparsers.add_parser('status', help='Show done/error/running/queued subjects per stage, the current recon-all step of running subjects and the ETA.')
+    status.add_argument('-i', '--input', type=str, help='Path to recon_all_input.txt file. Subjects without a folder in SUBJECTS_DIR are reported as queued.', default=None)
+    status.add_argument('-p', '--parallel', type=int, help='Number of parallel runs used for the ETA (default: number of running subjects).', default=None)
+    status.add_argument('-w', '--watch', type=float, help='Refresh the status every WATCH seconds.', default=None)
+    status.add_argument('-v', '--verbose', action='store_true', help='List the subjects in each state.')
+    status.add_argument('--cache', type=str, help='JSON file caching the status of each subject folder between refreshes.', default=None)
+    status.add_argument('--history', type=str, help='Tab separated history file used for the ETA (default: runtime_history.tsv).', default='runtime_history.tsv')
+    status.add_argument('--offsets', type=str, help='JSON file keeping the read offset of each recon-all.log, so only new lines are parsed on the next call.', default=None)
+
+    worker = subparsers.add_parser('worker', help='Run jobs from a shared queue directory filled by run.py --queue.')
+    worker.add_argument('--queue', type=str, help='Shared queue directory.', required=True)
+    worker.add_argument('-p', '--parallel', type=int, help='Number of jobs run at the same time by this worker (default: number of CPUs).', default=mp.cpu_count())
+    worker.add_argument('--scratch', type=str, help='Node-local scratch directory where recon-all [CROSS], [BASE] and [LONG] jobs are run.', default=None)
+    worker.add_argument('--idle', type=float, help='Stop after IDLE seconds without pending jobs (default: run until a "stop" file is created in the queue directory).', default=None)
+
+    pipeline = subparsers.add_parser('pipeline', parents=[common], help='Run recon-all [CROSS], [BASE], [LONG] and segment_HA [LONG] as a per-subject dependency graph.')
+    pipeline.add_argument('-i', '--input', type=str, help='Path to recon_all_input.txt file. Required columns: id (unique ID), subject (subject base ID), visit (time point), dcm_path (path to dcm/nii file).', required=True)
    
-    return parser.parse_args()
+    parsed = parser.parse_args(args)
+    if parsed.command is None:
+        parser.print_help()
+    return parsed
 
-def worker(cmd: str) -> "subprocess.run":
+def parse_timeouts(values: list) -> dict:
     """
-    Invokes a subprocess running the command.
+    Parses the --timeout values.
 
     Parameters
     ----------
-    cmd : str
-        Command-line string
+    values : list
+        Strings "<hours>" (all stages) or "<stage>=<hours>".
 
     Returns
     -------
-    subprocess.run()
-    
+    dict
+        Stage to limit in seconds, "*" for all stages.
+
     """
 
-    return subprocess.run(cmd, shell=True)
+    timeouts = dict()
+    for value in values or []:
+        stage, _, hours = value.rpartition('=')
+        timeouts[stage or '*'] = float(hours) * 3600
+    return timeouts
+
+def sweep_ratios(args: "argparse.Namespace") -> list:
+    """Returns the gcut_sweep --ratios values."""
+    return [ratio.strip() for ratio in args.ratios.split(',') if ratio.strip()]
+
+def sweep_cache(args: "argparse.Namespace") -> str:
+    """Returns the path of the gcut_sweep cache file."""
+    return args.cache or f"{os.path.splitext(args.input)[0]}_gcut_sweep.json"
 
-def run_command(args: list):
+def copy_files(pairs: list):
     """
-    Pass the appropriate command function to the worker.
+    Copies files.
 
     Parameters
     ----------
-    args : list
-        Command-line arguments list
+    pairs : list
+        (source, destination) path tuples, copied in order.
 
     Returns
     -------
     None
-    
+
+    """
+
+    for source, destination in pairs:
+        shutil.copyfile(source, destination)
+
+def build_pipeline_jobs(recon_input: str, subjects_dir: str) -> list:
+    """
+    Creates the dependency graph of the pipeline sub-command.
+
+    For each subject: recon-all [CROSS] for every time point, recon-all [BASE]
+    once all time points are done, recon-all [LONG] for every time point once
+    the base is done and segment_HA [LONG] once all long runs are done.
+
+    Parameters
+    ----------
+    recon_input : str
+        Path to recon_all_input.txt file.
+    subjects_dir : str
+        FreeSurfer SUBJECTS_DIR.
+
+    Returns
+    -------
+    list
+        List of Job objects with their dependencies set.
+
+    """
+
+    df = pd.read_csv(recon_input, sep='\t', dtype=str)
+    df['visit'] = df['visit'].astype(int)
+    df = df.sort_values(by=['subject', 'visit'], kind='stable')
+
+    jobs = list()
+    for subject, subject_tp in df.groupby('subject', sort=False):
+        ids = list(subject_tp['id'])
+        for id, dcm_path in zip(ids, subject_tp['dcm_path']):
+            jobs.append(Job(id, ['recon-all', '-all', '-s', id, '-i', dcm_path], id, 'recon_all', clean=[os.path.join(subjects_dir, id)]))
+
+        tp_flags = [flag for id in ids for flag in ('-tp', id)]
+        jobs.append(Job(subject, ['recon-all', '-base', subject] + tp_flags + ['-all'], subject, 'recon_base', clean=[os.path.join(subjects_dir, subject)], deps=ids))
+
+        long_names = [f"{id}.long.{subject}" for id in ids]
+        for id, name in zip(ids, long_names):
+            jobs.append(Job(name, ['recon-all', '-long', id, subject, '-all'], id, 'recon_long', clean=[os.path.join(subjects_dir, name)], deps=[subject]))
+
+        jobs.append(Job(f"{subject}.segmentHA_long", ['segmentHA_T1_long.sh', subject], subject, 'segment_HA_long', deps=long_names))
+
+    return jobs
+
+def build_jobs(args: "argparse.Namespace") -> list:
+    """
+    Creates the list of jobs for the selected sub-command.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command-line arguments
+
+    Returns
+    -------
+    list
+        Lists of Job objects. Jobs in the same inner list can run in parallel,
+        each list only starts after the previous one is finished.
+
     """
 
+    subjects_dir = os.environ.get('SUBJECTS_DIR', 'FS_OUTPUTS')
+
+    def mri(id, filename):
+        return os.path.join(subjects_dir, id, 'mri', filename)
+
     if args.command == "recon_all":
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --header : recon-all -all -s {{id}} -i {{dcm_path}} :::: {args.input}"
-        worker(cmd)
-        
+        df = pd.read_csv(args.input, sep='\t', dtype=str)
+        return [[Job(id, ['recon-all', '-all', '-s', id, '-i', dcm_path], id, args.command, clean=[os.path.join(subjects_dir, id)])
+                 for id, dcm_path in zip(df['id'], df['dcm_path'])]]
+
     if args.command == "recon_base":
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --colsep '\t' {{1}} :::: {args.input}"
-        worker(cmd)
-    
+        tasks = read_tasks(args.input, args.command).to_dict(orient='records')
+        return [[Job(task_name(task), task_argv(task), task['subject'], args.command, clean=[os.path.join(subjects_dir, task_name(task))])
+                 for task in tasks]]
+
     if args.command == "recon_long":
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --colsep '\t' {{1}} :::: {args.input}"
-        worker(cmd)
-        
+        tasks = read_tasks(args.input, args.command).to_dict(orient='records')
+        return [[Job(task_name(task), task_argv(task), task['id'], args.command, clean=[os.path.join(subjects_dir, task_name(task))])
+                 for task in tasks]]
+
     if args.command == "segment_HA":
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --header : segmentHA_T1.sh {{id}} :::: {args.input}"
-        worker(cmd)
-    
+        df = pd.read_csv(args.input, sep='\t', dtype=str)
+        return [[Job(f"{id}.segmentHA", ['segmentHA_T1.sh', id], id, args.command) for id in df['id']]]
+
     if args.command == "segment_HA_long":
-        subjects = pd.read_csv(args.input, sep='\t', usecols=['subject'])['subject'].unique()
-        subjects_str = ' '.join(subjects)
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} segmentHA_T1_long.sh ::: {subjects_str}"
-        worker(cmd)
-        
-    if args.command == "edit":  
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --header : mri_gcut -110 -T {{ratio}} -mult $SUBJECTS_DIR/{{id}}/mri/brainmask.auto.mgz $SUBJECTS_DIR/{{id}}/mri/T1.mgz $SUBJECTS_DIR/{{id}}/mri/brainmask.tmp{{ratio}}.mgz $SUBJECTS_DIR/{{id}}/mri/brainmask.gcutsT{{ratio}}.mgz :::: {args.input}"
-        worker(cmd)
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --header : mri_binarize --i $SUBJECTS_DIR/{{id}}/mri/brainmask.gcutsT{{ratio}}.mgz --o $SUBJECTS_DIR/{{id}}/mri/brainmask.gcutsT{{ratio}}.mgz --binval 999 --min 1 :::: {args.input}"
-        worker(cmd)
-        
+        subjects = pd.read_csv(args.input, sep='\t', usecols=['subject'], dtype=str)['subject'].unique()
+        return [[Job(f"{subject}.segmentHA_long", ['segmentHA_T1_long.sh', subject], subject, args.command) for subject in subjects]]
+
+    if args.command == "edit":
+        # mri_binarize of a subject starts as soon as its mri_gcut is done
+        df = pd.read_csv(args.input, sep='\t', dtype=str)
+        jobs = list()
+        for id, ratio in zip(df['id'], df['ratio']):
+            jobs.append(Job(f"{id}.gcut", ['mri_gcut', '-110', '-T', ratio, '-mult', mri(id, 'brainmask.auto.mgz'), mri(id, 'T1.mgz'), mri(id, f'brainmask.tmp{ratio}.mgz'), mri(id, f'brainmask.gcutsT{ratio}.mgz')], id, args.command))
+            jobs.append(Job(f"{id}.binarize", ['mri_binarize', '--i', mri(id, f'brainmask.gcutsT{ratio}.mgz'), '--o', mri(id, f'brainmask.gcutsT{ratio}.mgz'), '--binval', '999', '--min', '1'], id, args.command, deps=[f"{id}.gcut"]))
+        return [jobs]
+
     if args.command == "recon_edit":
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --header : cp $SUBJECTS_DIR/{{id}}/mri/brainmask.tmp{{ratio}}.mgz $SUBJECTS_DIR/{{id}}/mri/brainmask.auto.mgz :::: {args.input}"
-        worker(cmd)
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --header : cp $SUBJECTS_DIR/{{id}}/mri/brainmask.tmp{{ratio}}.mgz $SUBJECTS_DIR/{{id}}/mri/brainmask.mgz :::: {args.input}"
-        worker(cmd)
-        cmd=f"parallel --tmpdir tmpdir/ --lb -j {args.parallel} --header : recon-all -autorecon2-wm -autorecon3 -s {{id}} :::: {args.input}"
-        worker(cmd)
+        # The edited mask is copied in-process, then recon-all of the subject starts
+        df = pd.read_csv(args.input, sep='\t', dtype=str)
+        jobs = list()
+        for id, ratio in zip(df['id'], df['ratio']):
+            copies = [(mri(id, f'brainmask.tmp{ratio}.mgz'), mri(id, 'brainmask.auto.mgz')), (mri(id, f'brainmask.tmp{ratio}.mgz'), mri(id, 'brainmask.mgz'))]
+            jobs.append(Job(f"{id}.copy", ['cp'] + [path for pair in copies for path in pair], id, args.command, action=partial(copy_files, copies)))
+            jobs.append(Job(id, ['recon-all', '-autorecon2-wm', '-autorecon3', '-s', id], id, args.command, deps=[f"{id}.copy"]))
+        return [jobs]
+
+    if args.command == "gcut_sweep":
+        # Ratios of a subject run in parallel, each mask is measured as soon as it is written
+        df = pd.read_csv(args.input, sep='\t', dtype=str)
+        return [sweep_jobs(list(df['id']), sweep_ratios(args), subjects_dir, sweep_cache(args))]
+
+    if args.command == "pipeline":
+        return [build_pipeline_jobs(args.input, subjects_dir)]
+
+    return []
+
+def run_command(args: list) -> list:
+    """
+    Build the jobs for the selected command and run them with the scheduler.
+
+    Parameters
+    ----------
+    args : list
+        Command-line arguments list
+
+    Returns
+    -------
+    list
+        JobResult for each job that was run.
+    
+    """
+
+    subjects_dir = os.environ.get('SUBJECTS_DIR', 'FS_OUTPUTS')
+
+    if args.command is None:
+        return []
+
+    if args.command == "history":
+        history = update_history(args.history, collect_history(subjects_dir))
+        print(f"{len(history)} records in {args.history}")
+        return []
+
+    if args.command == "status":
+        model = RuntimeModel(read_history(args.history))
+        reader = ReconAllLogReader(args.offsets, tail=TAIL_BYTES)
+        while True:
+            print_status(status_report(subjects_dir, args.input, args.cache, model, reader), args.parallel, args.verbose)
+            reader.save()
+            if not args.watch:
+                return []
+            time.sleep(args.watch)
+            print("")
+
+    if args.command == "worker":
+        run_worker(args.queue, args.parallel, args.idle, Scratch(args.scratch, subjects_dir) if args.scratch else None)
+        return []
+
+    stages = build_jobs(args)
+
+    timeouts = parse_timeouts(args.timeout)
+    for jobs in stages:
+        for job in jobs:
+            job.timeout = timeouts.get(job.stage, timeouts.get('*'))
+            if args.stall and job.argv[:1] == ['recon-all']:
+                # recon-all jobs are named after their subject folder
+                job.stall = args.stall * 60
+                job.log = os.path.join(subjects_dir, job.name, 'scripts', 'recon-all.log')
+
+    journal_path = args.journal or f"{os.path.splitext(args.input)[0]}_journal.jsonl"
+    if args.plan:
+        costs = read_costs(args.costs) if args.costs else DEFAULT_COSTS
+        states = read_journal(journal_path) if args.resume else None
+        print_plan(plan_jobs(stages, subjects_dir, args.parallel, RuntimeModel(read_history(args.history)), costs, states, args.order), args.parallel)
+        return []
+
+    queue = WorkQueue(args.queue, args.lease) if args.queue else None
+    if args.resume:
+        states = read_journal(journal_path)
+        if queue is not None:
+            # Stop the workers of the previous coordinator before their subject folders are removed
+            claimed = queue.clear()
+            print(f"Cleared the queue in {args.queue}: {len(claimed)} jobs of the previous run were still claimed")
+        stages = [prepare_resume(jobs, states, subjects_dir) for jobs in stages]
+        if args.scratch:
+            # Orphaned scratch folders and partial copies of interrupted jobs
+            scratch = Scratch(args.scratch, subjects_dir)
+            for jobs in stages:
+                for job in jobs:
+                    scratch.clean(job.name)
+        print(f"Resuming from {journal_path}: {sum(len(jobs) for jobs in stages)} jobs left")
+    journal = Journal(journal_path, append=args.resume)
+
+    if args.order == "longest":
+        model = RuntimeModel(read_history(args.history))
+        for jobs in stages:
+            for job in jobs:
+                job.duration = model.predict_job(job)
+
+    if queue is not None:
+        # Each worker limits its own number of running jobs
+        scheduler = Scheduler(args.parallel, args.retries, journal=journal, runner=queue.run,
+                              backoff=args.backoff, logs=args.logs)
+    else:
+        costs = read_costs(args.costs) if args.costs else DEFAULT_COSTS
+        budget = ResourceBudget(args.parallel, memory=args.memory, costs=costs, openmp=args.openmp)
+        runner = Scratch(args.scratch, subjects_dir).run if args.scratch else None
+        scheduler = Scheduler(args.parallel, args.retries, budget, journal, runner, args.backoff, args.logs)
+    results = list()
+    try:
+        for jobs in stages:
+            results.extend(scheduler.run(jobs))
+    finally:
+        journal.close()
+
+    records = results_to_records(results)
+    if len(records):
+        update_history(args.history, records)
+
+    if args.report:
+        write_report(results, args.report)
+
+    if args.command == "gcut_sweep":
+        output = args.output or f"{os.path.splitext(args.input)[0]}_gcut_sweep.tsv"
+        merge_cache(sweep_cache(args))
+        sweep = summarize_sweep(args.input, sweep_ratios(args), sweep_cache(args), output, args.max_removed)
+        for row in sweep.itertuples(index=False):
+            if pd.isna(row.ratio):
+                print(f"WARNING: {row.id}: every ratio removes more than {args.max_removed:.1%} of brainmask.auto.mgz")
+        print(f"Recommended ratios written to {output}")
+
+    return results
 
 if __name__ == '__main__':
     args = argument_parser(sys.argv[1:])
-    run_command(args)
-    
+    results = run_command(args)
+    if any(result.status != "done" for result in results):
+        sys.exit(1)
@@ -3,19 +3,29 @@
 This file can also be imported as a module and contains the following
 functions:
 
+    * scan_subject - scans the folder of a single subject.
     * create_recon_all_input - creates the recon-all input table.
+    * group_timepoints - groups the time points of the input table by subject.
+    * base_commands - returns the recon-all base commands.
+    * long_commands - returns the recon-all long commands.
     * create_recon_base_input - creates the recon-all base input table.
-    * create_recon_long_input - creates the recon-all base input table.
+    * create_recon_long_input - creates the recon-all long input table.
+    * create_recon_base_long_input - creates the recon-all base and long input tables.
 
 """
 
 import sys
 import argparse
 import os
-from glob import glob
+import fnmatch
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.dicom_index import SUMMARY_COLUMNS, index_sessions
+from scripts.manifest import create_manifest, write_manifest
+
 # Folder organization is assumed to be in the following ADNI format:
 # ADNI/ALL_SUBJECTS/MP-RAGE/ALL_TIME_POINTS/SESSION_ID/FIRST_DCM_FILE
 
@@ -39,16 +49,74 @@ def argument_parser(args: list) -> "ArgumentParser.parse_args":
 
     all = subparsers.add_parser('all', help='Create input for recon-all [CROSS].')
     all.add_argument('-i', '--input', type=str, help='Path to directory containing the samples.', required=True)
+    all.add_argument('-j', '--jobs', type=int, help='Number of subject folders scanned (and processes reading DICOM headers) in parallel (default: 1).', default=1)
+    all.add_argument('--index', action='store_true', help='Read the DICOM headers of each session, validate the series and add the summary columns to the table; invalid sessions are written to recon_all_input_rejected.txt instead (requires pydicom).')
+    all.add_argument('--cache', type=str, help='JSON file caching the DICOM headers by file path and modification time (used with --index).', default=None)
     
     base = subparsers.add_parser('base', help='Create input for recon-all [BASE].')
     base.add_argument('-i', '--input', type=str, help='Path to recon_all_input.txt file used for cross processing.', required=True)
     
     long = subparsers.add_parser('long', help='Create input for recon-all [LONG].')
     long.add_argument('-i', '--input', type=str, help='Path to recon_all_input.txt file used for cross processing.', required=True)
+
+    base_long = subparsers.add_parser('base_long', help='Create inputs for recon-all [BASE] and [LONG] in one pass.')
+    base_long.add_argument('-i', '--input', type=str, help='Path to recon_all_input.txt file used for cross processing.', required=True)
+    base_long.add_argument('-o', '--output', type=str, help='Path to the task manifest, JSON if it ends with .json (default: recon_base_long_input.tsv).', default='recon_base_long_input.tsv')
     
     return parser.parse_args()
 
-def create_recon_all_input(base_dir: str):
+def scan_subject(base_dir: str, subject: str) -> list:
+    """
+    Scans the folder of a single subject.
+
+    Parameters
+    ----------
+    base_dir : str
+        Path to directory containing the samples.
+    subject : str
+        SUBJECT ID (folder name).
+
+    Returns
+    -------
+    list
+        One record (dict) per time point, sorted by scan date.
+
+    """
+
+    # ALL_SUBJECTS/MP-RAGE/ALL_TIME_POINTS
+    time_points = list()
+    with os.scandir(os.path.join(base_dir, subject)) as series:
+        for serie in series:
+            if not serie.is_dir():
+                continue
+            with os.scandir(serie.path) as dates:
+                time_points.extend((entry.name, entry.path) for entry in dates if entry.is_dir())
+    time_points.sort(key=lambda tp: datetime.strptime(tp[0], '%Y-%m-%d_%H_%M_%S.%f'))
+
+    records = list()
+    for visit, (time_str, tp) in enumerate(time_points):
+        # ALL_TIME_POINTS/SESSION_ID
+        with os.scandir(tp) as entries:
+            session = [entry for entry in entries]
+        assert len(session) == 1, "More than one session per date"
+        session = session[0]
+
+        # SESSION_ID/FIRST_DCM_FILE
+        with os.scandir(session.path) as entries:
+            dcm_path = sorted(entry.path for entry in entries if fnmatch.fnmatch(entry.name, '*_1_*'))
+
+        records.append({
+            'id': f"{subject}_{session.name}",
+            'subject': subject,
+            'session': session.name,
+            'date': time_str,
+            'visit': visit + 1,
+            'dcm_path': dcm_path[0] if dcm_path else None,
+        })
+
+    return records
+
+def create_recon_all_input(base_dir: str, jobs: int = 1, index: bool = False, cache: str = None):
     """
     Creates a 6 column text file to be used as input for the main script recon-all command.
     First column: unique ID (combines SUBJECT ID and SESSION ID).
@@ -58,10 +126,26 @@ def create_recon_all_input(base_dir: str):
     Fifth column: Time point relative to the ones contained in the subject folder.
     Sixth column: path to DICOM file.
 
+    The folder tree is walked once with os.scandir and the table is built
+    from all records at the end.
+
+    With index=True, the DICOM headers of each session are read and the
+    columns n_files, n_slices, expected_slices, rows, columns,
+    slice_thickness, series_description, series_uid, valid and problem are
+    added (see scripts/dicom_index.py). Invalid sessions are reported and
+    moved to recon_all_input_rejected.txt, with the same columns, so they
+    are not run.
+
     Parameters
     ----------
     base_dir : str
         Path to directory containing the samples.
+    jobs : int, default=1
+        Number of subject folders scanned in parallel.
+    index : bool, default=False
+        Read and validate the DICOM headers of each session.
+    cache : str, default=None
+        JSON file caching the DICOM headers (used with index=True).
 
     Returns
     -------
@@ -69,35 +153,94 @@ def create_recon_all_input(base_dir: str):
 
     """
     
-    df_input = pd.DataFrame()
-    
     base_dir = base_dir.split('/')[0]
-    subjects_dir = os.listdir(base_dir)
-    
-    for subject in subjects_dir:
-        time_points = glob(os.path.join(base_dir,subject,'*','*'))
-        time_points.sort(key=lambda x: datetime.strptime(x.split('/')[-1], '%Y-%m-%d_%H_%M_%S.%f'))
-        
-        for visit,tp in enumerate(time_points):
-            session = os.listdir(tp)
-            assert len(session) == 1, "More than one session per date"
-            session = session[0]
-            time_str = tp.split('/')[-1]
-            dcm_path = glob(os.path.join(tp, session, '*_1_*'))
-        
-            df_temp = pd.DataFrame()
-            df_temp['id'] = pd.Series(f"{subject}_{session}")
-            df_temp['subject'] = pd.Series(subject)
-            df_temp['session'] = pd.Series(session)
-            df_temp['date'] = pd.Series(time_str)
-            df_temp['visit'] = pd.Series(visit+1)
-            df_temp['dcm_path'] = pd.Series(dcm_path)
-            
-            df_input = pd.concat([df_input, df_temp])
-            
+    with os.scandir(base_dir) as entries:
+        subjects = sorted(entry.name for entry in entries if entry.is_dir())
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        records = [record for subject_records in executor.map(lambda subject: scan_subject(base_dir, subject), subjects)
+                   for record in subject_records]
+
+    df_input = pd.DataFrame(records, columns=['id', 'subject', 'session', 'date', 'visit', 'dcm_path'])
+
+    if index:
+        sessions = df_input['dcm_path'].dropna().map(os.path.dirname)
+        summaries = index_sessions(list(sessions.unique()), jobs, cache)
+        summary = pd.DataFrame([summaries.get(os.path.dirname(path), {}) if isinstance(path, str) else {} for path in df_input['dcm_path']],
+                               columns=SUMMARY_COLUMNS, index=df_input.index)
+        df_input = pd.concat([df_input, summary], axis=1)
+        for id, problem in zip(df_input['id'], df_input['problem']):
+            if isinstance(problem, str):
+                print(f"WARNING: {id}: {problem}")
+        # Written on every run with --index, so it never lists sessions of an older scan
+        rejected = df_input['valid'].eq(False)
+        df_input[rejected].to_csv("recon_all_input_rejected.txt", sep="\t", index=False, header=True)
+        if rejected.any():
+            print(f"{rejected.sum()} invalid sessions written to recon_all_input_rejected.txt instead of recon_all_input.txt")
+        df_input = df_input[~rejected]
+
     df_input.to_csv("recon_all_input.txt", sep="\t", index=False, header=True)
     
 
+def group_timepoints(recon_input: str) -> list:
+    """
+    Groups the time points of recon_all_input.txt by subject.
+
+    The table is read once, sorted by subject (in order of first appearance)
+    and visit, and split with a single groupby pass.
+
+    Parameters
+    ----------
+    recon_input : str
+        Path to recon_all_input.txt file used for cross processing.
+
+    Returns
+    -------
+    list
+        (subject, list of unique IDs sorted by visit) tuples.
+
+    """
+
+    df_recon = pd.read_csv(recon_input, sep="\t", index_col=False, dtype=str)
+    df_recon['order'] = pd.factorize(df_recon['subject'])[0]
+    df_recon['visit'] = pd.to_numeric(df_recon['visit'])
+    df_recon = df_recon.sort_values(by=['order', 'visit'], kind='mergesort')
+    return [(subject, list(subject_tp['id'])) for subject, subject_tp in df_recon.groupby('subject', sort=False)]
+
+def base_commands(timepoints: list) -> list:
+    """
+    Returns the recon-all base commands, one per subject.
+
+    Parameters
+    ----------
+    timepoints : list
+        Output of group_timepoints.
+
+    Returns
+    -------
+    list
+
+    """
+
+    return [f"recon-all -base {subject} {' '.join(f'-tp {id}' for id in ids)} -all" for subject, ids in timepoints]
+
+def long_commands(timepoints: list) -> list:
+    """
+    Returns the recon-all long commands, one per time point.
+
+    Parameters
+    ----------
+    timepoints : list
+        Output of group_timepoints.
+
+    Returns
+    -------
+    list
+
+    """
+
+    return [f"recon-all -long {id} {subject} -all" for subject, ids in timepoints for id in ids]
+
 def create_recon_base_input(recon_input: str):
     """
     Creates a single column text file to be used as input for the main script recon-all base command.
@@ -114,18 +257,8 @@ def create_recon_base_input(recon_input: str):
 
     """
     
-    df_recon = pd.read_csv(recon_input, sep="\t", index_col=False)
-    subjects = df_recon['subject'].unique()
-    base_commands = list()
-    for subject in subjects:
-        subject_tp = df_recon[df_recon['subject']==subject]
-        subject_tp = subject_tp.reset_index()
-        subject_tp.sort_values(by=['visit'], ascending=True, inplace=True)
-        tp_flags = ' '.join([f"-tp {subject_tp.iloc[tp]['id']}" for tp in range(len(subject_tp))])
-        base_commands.append(f"recon-all -base {subject} {tp_flags} -all")
-    
     with open('recon_base_input.txt', 'w') as f:
-        f.write("\n".join(str(cmd) for cmd in base_commands))
+        f.write("\n".join(base_commands(group_timepoints(recon_input))))
             
     
 def create_recon_long_input(recon_input: str):
@@ -144,24 +277,52 @@ def create_recon_long_input(recon_input: str):
 
     """
     
-    df_recon = pd.read_csv(recon_input, sep="\t", index_col=False)
-    subjects = df_recon['subject'].unique()
-    long_commands = list()
-    for subject in subjects:
-        subject_tp = df_recon[df_recon['subject']==subject]
-        subject_tp = subject_tp.reset_index()
-        subject_tp.sort_values(by=['visit'], ascending=True, inplace=True)
-        for tp in range(len(subject_tp)):
-            long_commands.append(f"recon-all -long {subject_tp.iloc[tp]['id']} {subject} -all")
+    with open('recon_long_input.txt', 'w') as f:
+        f.write("\n".join(long_commands(group_timepoints(recon_input))))
+
+def create_recon_base_long_input(recon_input: str, manifest: str = "recon_base_long_input.tsv"):
+    """
+    Creates the recon-all base and long inputs from a single scan of recon_all_input.txt.
 
+    Writes recon_base_input.txt and recon_long_input.txt (see
+    create_recon_base_input and create_recon_long_input) and a task
+    manifest with one row per base and long job (see scripts/manifest.py),
+    which run.py recon_base and recon_long accept as input.
+
+    Parameters
+    ----------
+    recon_input : str
+        Path to recon_all_input.txt file used for cross processing.
+    manifest : str, default="recon_base_long_input.tsv"
+        Path to the manifest, JSON if it ends with .json, tab separated otherwise.
+
+    Returns
+    -------
+    None
+
+    """
+
+    timepoints = group_timepoints(recon_input)
+
+    with open('recon_base_input.txt', 'w') as f:
+        f.write("\n".join(base_commands(timepoints)))
     with open('recon_long_input.txt', 'w') as f:
-        f.write("\n".join(str(cmd) for cmd in long_commands))
+        f.write("\n".join(long_commands(timepoints)))
+
+    write_manifest(create_manifest(timepoints), manifest)
         
 if __name__ == '__main__':
     args = argument_parser(sys.argv[1:])
     if args.command == 'all':
-        create_recon_all_input(args.input)
+        if args.index:
+            import importlib.util
+            if importlib.util.find_spec("pydicom") is None:
+                print("ERROR: the 'pydicom' package is required for --index, please install.")
+                sys.exit(1)
+        create_recon_all_input(args.input, args.jobs, args.index, args.cache)
     if args.command == 'base':
         create_recon_base_input(args.input)
     if args.command == 'long':
-        create_recon_long_input(args.input)
\ No newline at end of file
+        create_recon_long_input(args.input)
+    if args.command == 'base_long':
+        create_recon_base_long_input(args.input, args.output)
\ No newline at end of file
@@ -0,0 +1,259 @@
+"""Script to index and validate the DICOM series used as recon-all input
+
+Only the DICOM headers are read (pixel data is skipped), in parallel over
+all files. For each session folder the slice count and the consistency of
+the series (single SeriesInstanceUID, same matrix size, contiguous instance
+numbers, number of files matching ImagesInAcquisition) are checked, so that
+incomplete series are found before recon-all fails on them hours later.
+Headers can be cached to a JSON file keyed by file path and modification
+time, so only new or changed files are read again.
+
+Requires the pydicom package.
+
+usage: python dicom_index.py -i recon_all_input.txt
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * read_header - reads the header fields of a single DICOM file.
+    * read_headers - reads the headers of many DICOM files in parallel.
+    * summarize_session - validates the headers of one session folder.
+    * index_sessions - indexes and validates session folders.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+# Header fields read from each file
+FIELDS = ['SeriesInstanceUID', 'SeriesDescription', 'InstanceNumber', 'Rows', 'Columns', 'ImagesInAcquisition', 'SliceThickness']
+
+# Columns added to the recon-all input table
+SUMMARY_COLUMNS = ['n_files', 'n_slices', 'expected_slices', 'rows', 'columns', 'slice_thickness', 'series_description', 'series_uid', 'valid', 'problem']
+
+def argument_parser(args: list) -> "ArgumentParser.parse_args":
+    """
+    Parser for command-line options and arguments.
+
+    Parameters
+    ----------
+    args : list
+        Command-line arguments list
+
+    Returns
+    -------
+    Parser
+
+    """
+
+    parser = argparse.ArgumentParser(description="Index and validate the DICOM series of a recon-all input table.")
+    parser.add_argument('-i', '--input', type=str, help='Path to recon_all_input.txt file. Required column: dcm_path.', required=True)
+    parser.add_argument('-j', '--jobs', type=int, help='Number of processes reading headers (default: number of CPUs).', default=os.cpu_count())
+    parser.add_argument('--cache', type=str, help='JSON file caching the headers by file path and modification time.', default=None)
+
+    return parser.parse_args(args)
+
+def read_header(path: str) -> dict:
+    """
+    Reads the header fields of a single DICOM file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the DICOM file.
+
+    Returns
+    -------
+    dict
+        Values of FIELDS (None if missing). Empty if the file is not a
+        readable DICOM file.
+
+    """
+
+    import pydicom
+
+    header = dict()
+    with warnings.catch_warnings():
+        # Non-conformant values (e.g. UIDs with leading zeros) are common and harmless here
+        warnings.simplefilter("ignore")
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=FIELDS)
+            for field in FIELDS:
+                value = ds.get(field)
+                if value is None or value == '':
+                    header[field] = None
+                elif field in ('SeriesInstanceUID', 'SeriesDescription'):
+                    header[field] = str(value)
+                elif field == 'SliceThickness':
+                    header[field] = float(value)
+                else:
+                    header[field] = int(value)
+        except Exception:
+            return {}
+    return header
+
+def read_headers(paths: list, jobs: int = 1, cache: dict = None) -> dict:
+    """
+    Reads the headers of many DICOM files in parallel.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to DICOM files.
+    jobs : int, default=1
+        Number of processes.
+    cache : dict, default=None
+        Path to {"mtime": ns, "header": dict}, updated in place. Files with an
+        unchanged modification time are not read again.
+
+    Returns
+    -------
+    dict
+        Path to header, see read_header.
+
+    """
+
+    cache = cache if cache is not None else dict()
+    headers = dict()
+    to_read = list()
+    mtimes = dict()
+    for path in paths:
+        mtime = os.stat(path).st_mtime_ns
+        entry = cache.get(path)
+        if entry is not None and entry['mtime'] == mtime:
+            headers[path] = entry['header']
+        else:
+            mtimes[path] = mtime
+            to_read.append(path)
+
+    if to_read:
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                new_headers = list(executor.map(read_header, to_read, chunksize=64))
+        else:
+            new_headers = [read_header(path) for path in to_read]
+        for path, header in zip(to_read, new_headers):
+            headers[path] = header
+            cache[path] = {'mtime': mtimes[path], 'header': header}
+
+    return headers
+
+def summarize_session(headers: list) -> dict:
+    """
+    Validates the headers of one session folder.
+
+    Parameters
+    ----------
+    headers : list
+        Headers of all files in the session folder, see read_header.
+
+    Returns
+    -------
+    dict
+        Values of SUMMARY_COLUMNS. valid is False and problem describes the
+        first issue found if the series is inconsistent or incomplete.
+
+    """
+
+    readable = [header for header in headers if header]
+    series = {header['SeriesInstanceUID'] for header in readable}
+    matrix = {(header['Rows'], header['Columns']) for header in readable}
+    instances = sorted(header['InstanceNumber'] for header in readable if header['InstanceNumber'] is not None)
+    expected = {header['ImagesInAcquisition'] for header in readable if header['ImagesInAcquisition'] is not None}
+    first = readable[0] if readable else {}
+
+    summary = {
+        'n_files': len(headers),
+        'n_slices': len(set(instances)),
+        'expected_slices': expected.pop() if len(expected) == 1 else None,
+        'rows': first.get('Rows'),
+        'columns': first.get('Columns'),
+        'slice_thickness': first.get('SliceThickness'),
+        'series_description': first.get('SeriesDescription'),
+        'series_uid': first.get('SeriesInstanceUID'),
+        'valid': True,
+        'problem': None,
+    }
+
+    if not readable:
+        problem = "no readable DICOM files"
+    elif len(readable) < len(headers):
+        problem = f"{len(headers) - len(readable)} unreadable files"
+    elif len(series) > 1:
+        problem = f"{len(series)} series in one session"
+    elif len(matrix) > 1:
+        problem = "inconsistent matrix size"
+    elif len(instances) != len(set(instances)):
+        problem = "duplicate instance numbers"
+    elif instances and instances[-1] - instances[0] + 1 != len(instances):
+        problem = f"missing slices ({instances[-1] - instances[0] + 1 - len(instances)} instance numbers missing)"
+    elif summary['expected_slices'] is not None and summary['expected_slices'] != len(instances):
+        problem = f"{len(instances)} of {summary['expected_slices']} slices"
+    else:
+        problem = None
+
+    if problem is not None:
+        summary['valid'] = False
+        summary['problem'] = problem
+    return summary
+
+def index_sessions(session_dirs: list, jobs: int = 1, cache_path: str = None) -> dict:
+    """
+    Indexes and validates session folders.
+
+    Parameters
+    ----------
+    session_dirs : list
+        Paths to session folders, each containing the DICOM files of one series.
+    jobs : int, default=1
+        Number of processes reading headers.
+    cache_path : str, default=None
+        JSON file caching the headers by file path and modification time.
+
+    Returns
+    -------
+    dict
+        Session folder to summary, see summarize_session.
+
+    """
+
+    cache = dict()
+    if cache_path and os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    files = dict()
+    for session_dir in session_dirs:
+        with os.scandir(session_dir) as entries:
+            files[session_dir] = sorted(entry.path for entry in entries if entry.is_file() and not entry.name.startswith('.'))
+
+    headers = read_headers([path for paths in files.values() for path in paths], jobs, cache)
+
+    if cache_path:
+        tmp = f"{cache_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, cache_path)
+
+    return {session_dir: summarize_session([headers[path] for path in paths]) for session_dir, paths in files.items()}
+
+if __name__ == '__main__':
+    import importlib.util
+    import pandas as pd
+
+    args = argument_parser(sys.argv[1:])
+    if importlib.util.find_spec("pydicom") is None:
+        print("ERROR: the 'pydicom' package is required for indexing DICOM headers, please install.")
+        sys.exit(1)
+
+    df = pd.read_csv(args.input, sep='\t', dtype=str)
+    sessions = df['dcm_path'].map(os.path.dirname)
+    summaries = index_sessions(list(sessions.unique()), args.jobs, args.cache)
+    for session, summary in summaries.items():
+        if not summary['valid']:
+            print(f"WARNING: {session}: {summary['problem']}")
+    print(f"{sum(summary['valid'] for summary in summaries.values())} of {len(summaries)} sessions valid")
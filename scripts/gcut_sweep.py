@@ -0,0 +1,255 @@
+"""Tissue ratio sweep for mri_gcut.
+
+For each subject, mri_gcut is run with a list of tissue ratios (-T) in
+parallel, writing the same brainmask.tmp<ratio>.mgz files as the edit
+sub-command. Each resulting mask is compared with brainmask.auto.mgz
+(voxel counts, voxels removed) with nibabel, and the largest ratio that
+removes at most a given fraction of the brainmask.auto.mgz voxels is
+recommended. Metrics are cached in a JSON file together with the
+modification times of the masks, so a rerun only processes new subjects
+and ratios, or masks that changed. During a run, each metrics job appends
+one line to <cache>.jsonl, merged into the JSON file once at the end of the
+run (or by the next run, if it was interrupted).
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * mask_metrics - compares a gcut mask with brainmask.auto.mgz.
+    * read_cache - reads the sweep cache.
+    * merge_cache - merges the metrics of a run into the sweep cache.
+    * sweep_jobs - creates the mri_gcut and metrics jobs of a sweep.
+    * recommend_ratio - recommends a tissue ratio from the metrics of a subject.
+    * summarize_sweep - writes the recommended ratio of each subject.
+
+"""
+
+import json
+import os
+import threading
+from functools import partial
+import numpy as np
+import pandas as pd
+
+from scripts.scheduler import Job
+
+DEFAULT_RATIOS = ['0.2', '0.3', '0.4', '0.5', '0.6', '0.7', '0.8']
+
+# Serializes appends to the cache journal by the metrics jobs
+_cache_lock = threading.Lock()
+
+def mask_metrics(auto_path: str, mask_path: str) -> dict:
+    """
+    Compares a gcut mask with brainmask.auto.mgz.
+
+    Parameters
+    ----------
+    auto_path : str
+        Path to brainmask.auto.mgz.
+    mask_path : str
+        Path to brainmask.tmp<ratio>.mgz.
+
+    Returns
+    -------
+    dict
+        auto_voxels and mask_voxels (non-zero voxels of each mask),
+        removed_voxels (in brainmask.auto.mgz but not in the gcut mask) and
+        removed_fraction (removed_voxels / auto_voxels).
+
+    """
+
+    import nibabel as nib
+
+    auto = np.asanyarray(nib.load(auto_path).dataobj) > 0
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+    auto_voxels = int(np.count_nonzero(auto))
+    removed_voxels = int(np.count_nonzero(auto & ~mask))
+    return {
+        'auto_voxels': auto_voxels,
+        'mask_voxels': int(np.count_nonzero(mask)),
+        'removed_voxels': removed_voxels,
+        'removed_fraction': removed_voxels / auto_voxels if auto_voxels else None,
+    }
+
+def _mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def read_cache(path: str) -> dict:
+    """
+    Reads the sweep cache.
+
+    Parameters
+    ----------
+    path : str
+        JSON cache file. Entries of its journal (<path>.jsonl) that are not
+        merged yet are included.
+
+    Returns
+    -------
+    dict
+        Unique ID to ratio to metrics (see mask_metrics) and the modification
+        times of both masks. Empty if the file does not exist.
+
+    """
+
+    cache = dict()
+    if os.path.isfile(path):
+        with open(path) as f:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                pass
+    if os.path.isfile(f"{path}.jsonl"):
+        with open(f"{path}.jsonl") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of an interrupted append
+                    continue
+                cache.setdefault(entry.pop('id'), dict())[entry.pop('ratio')] = entry
+    return cache
+
+def merge_cache(path: str):
+    """
+    Merges the metrics of a run into the sweep cache.
+
+    Parameters
+    ----------
+    path : str
+        JSON cache file. Its journal (<path>.jsonl) is removed.
+
+    Returns
+    -------
+    None
+
+    """
+
+    if not os.path.isfile(f"{path}.jsonl"):
+        return
+    cache = read_cache(path)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, path)
+    os.remove(f"{path}.jsonl")
+
+def _store_metrics(cache_path: str, id: str, ratio: str, auto_path: str, mask_path: str):
+    """Computes the metrics of one mask and appends them to the cache journal."""
+    entry = mask_metrics(auto_path, mask_path)
+    entry['auto_mtime'] = _mtime(auto_path)
+    entry['mask_mtime'] = _mtime(mask_path)
+    line = json.dumps(dict(entry, id=id, ratio=ratio)) + "\n"
+    with _cache_lock, open(f"{cache_path}.jsonl", 'a') as f:
+        f.write(line)
+
+def sweep_jobs(ids: list, ratios: list, subjects_dir: str, cache_path: str) -> list:
+    """
+    Creates the mri_gcut and metrics jobs of a sweep.
+
+    For each subject and ratio, an mri_gcut job is followed by an in-process
+    job computing the mask metrics. Subjects and ratios whose cached metrics
+    are still valid get no job.
+
+    Parameters
+    ----------
+    ids : list
+        Unique IDs processed with recon-all [CROSS].
+    ratios : list
+        Tissue ratios as strings, used in the mask file names.
+    subjects_dir : str
+        FreeSurfer SUBJECTS_DIR.
+    cache_path : str
+        JSON cache file.
+
+    Returns
+    -------
+    list
+        List of Job objects.
+
+    """
+
+    cache = read_cache(cache_path)
+    jobs = list()
+    for id in ids:
+        mri = os.path.join(subjects_dir, id, 'mri')
+        auto = os.path.join(mri, 'brainmask.auto.mgz')
+        for ratio in ratios:
+            tmp = os.path.join(mri, f'brainmask.tmp{ratio}.mgz')
+            cached = cache.get(id, {}).get(ratio)
+            if cached and cached['auto_mtime'] == _mtime(auto) and cached['mask_mtime'] == _mtime(tmp):
+                continue
+            gcut = f"{id}.gcut{ratio}"
+            jobs.append(Job(gcut, ['mri_gcut', '-110', '-T', ratio, '-mult', auto, os.path.join(mri, 'T1.mgz'), tmp, os.path.join(mri, f'brainmask.gcutsT{ratio}.mgz')], id, 'gcut_sweep'))
+            jobs.append(Job(f"{id}.metrics{ratio}", ['mask_metrics', auto, tmp], id, 'gcut_sweep', deps=[gcut],
+                            action=partial(_store_metrics, cache_path, id, ratio, auto, tmp)))
+    return jobs
+
+def recommend_ratio(metrics: dict, max_removed: float) -> str:
+    """
+    Recommends a tissue ratio from the metrics of a subject.
+
+    Larger ratios give a cleaner skull strip but a higher chance of brain
+    erosion, so the largest ratio removing at most max_removed of the
+    brainmask.auto.mgz voxels is chosen.
+
+    Parameters
+    ----------
+    metrics : dict
+        Ratio to metrics, see mask_metrics.
+    max_removed : float
+        Maximum fraction of brainmask.auto.mgz voxels removed.
+
+    Returns
+    -------
+    str
+        The recommended ratio, or None if every ratio removes more.
+
+    """
+
+    accepted = [ratio for ratio, entry in metrics.items()
+                if entry['removed_fraction'] is not None and entry['removed_fraction'] <= max_removed]
+    return max(accepted, key=float, default=None)
+
+def summarize_sweep(recon_input: str, ratios: list, cache_path: str, output: str, max_removed: float) -> pd.DataFrame:
+    """
+    Writes the recommended ratio of each subject.
+
+    Parameters
+    ----------
+    recon_input : str
+        Tab separated file with an id column.
+    ratios : list
+        Tissue ratios of the sweep.
+    cache_path : str
+        JSON cache file.
+    output : str
+        Tab separated output file: the input table with the columns ratio
+        (recommended ratio, empty if none) and removed_fraction, followed by
+        one removed_<ratio> column per ratio. It can be used as input of edit
+        and recon_edit once the subjects without a ratio are checked.
+    max_removed : float
+        Maximum fraction of brainmask.auto.mgz voxels removed.
+
+    Returns
+    -------
+    pd.DataFrame
+        The output table.
+
+    """
+
+    df = pd.read_csv(recon_input, sep='\t', dtype=str)
+    cache = read_cache(cache_path)
+    rows = list()
+    for id in df['id']:
+        metrics = {ratio: entry for ratio, entry in cache.get(id, {}).items() if ratio in ratios}
+        ratio = recommend_ratio(metrics, max_removed)
+        row = {'ratio': ratio, 'removed_fraction': metrics[ratio]['removed_fraction'] if ratio else None}
+        row.update({f'removed_{r}': metrics[r]['removed_fraction'] if r in metrics else None for r in ratios})
+        rows.append(row)
+    summary = pd.DataFrame(rows, index=df.index)
+    df = pd.concat([df.drop(columns=[column for column in summary.columns if column in df]), summary], axis=1)
+    df.to_csv(output, sep='\t', index=False, header=True)
+    return df
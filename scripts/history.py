@@ -0,0 +1,434 @@
+"""Runtime history store and runtime model used to order job dispatch.
+
+Wall times of finished jobs are stored in a tab separated history file, one
+row per job and stage. They are taken from the jobs run by run.py and from
+the recon-all.done / recon-all.log files found in SUBJECTS_DIR. A simple
+per-stage linear model on one input feature (voxel count of the input for
+recon-all [CROSS] and [LONG], number of time points for [BASE]) predicts the
+duration of new jobs, so the scheduler can start the longest jobs first.
+
+This file can also be imported as a module and contains the following
+functions and classes:
+
+    * parse_done_file - parses a recon-all.done file.
+    * parse_log_runtime - reads the run time from a recon-all.log file.
+    * input_voxels - estimates the voxel count of a recon-all input.
+    * job_feature - returns the model feature of a job.
+    * collect_history - collects wall times from a SUBJECTS_DIR.
+    * read_history - reads the history file.
+    * update_history - adds records to the history file.
+    * RuntimeModel - predicts job durations from the history.
+
+"""
+
+import os
+import time
+import numpy as np
+import pandas as pd
+
+# user_time to write_bytes: resource usage of jobs run by run.py (see scheduler.USAGE_FIELDS)
+HISTORY_COLUMNS = ['name', 'subject', 'stage', 'wall_time', 'feature', 'source', 'recorded',
+                   'user_time', 'sys_time', 'max_rss', 'read_bytes', 'write_bytes']
+
+# Fallback durations in hours, used when a stage has no history
+DEFAULT_HOURS = {
+    'recon_all': 8.0,
+    'recon_base': 3.0,
+    'recon_long': 5.0,
+    'recon_edit': 5.0,
+    'segment_HA': 0.75,
+    'segment_HA_long': 1.5,
+    'edit': 0.1,
+    'gcut_sweep': 0.1,
+}
+
+# Minimum number of records of a stage to fit the linear model
+MIN_RECORDS = 5
+
+def parse_done_file(path: str) -> dict:
+    """
+    Parses a recon-all.done file.
+
+    FreeSurfer 7 writes one "KEY value" pair per line (SUBJECT, START_TIME,
+    END_TIME, RUNTIME_HOURS, CMDARGS, ...).
+
+    Parameters
+    ----------
+    path : str
+        Path to recon-all.done.
+
+    Returns
+    -------
+    dict
+        Key to value, both as strings. Empty if the file cannot be read.
+
+    """
+
+    fields = dict()
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.strip().split(None, 1)
+                if len(parts) == 2 and parts[0].isupper():
+                    fields[parts[0]] = parts[1]
+    except OSError:
+        pass
+    return fields
+
+def parse_log_runtime(path: str) -> float:
+    """
+    Reads the run time from a recon-all.log file.
+
+    Parameters
+    ----------
+    path : str
+        Path to recon-all.log.
+
+    Returns
+    -------
+    float
+        Run time in hours from the last "recon-all-run-time-hours" line, or
+        None if it is not found. Only the end of the file is read.
+
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 16384))
+            tail = f.read().decode(errors='replace')
+    except OSError:
+        return None
+
+    hours = None
+    for line in tail.splitlines():
+        if 'recon-all-run-time-hours' in line:
+            try:
+                hours = float(line.split()[-1])
+            except ValueError:
+                pass
+    return hours
+
+def stage_from_args(cmdargs: str) -> str:
+    """
+    Returns the run.py stage of a recon-all run from its arguments.
+
+    Parameters
+    ----------
+    cmdargs : str
+        recon-all arguments, e.g. "-all -s <id> -i <file>".
+
+    Returns
+    -------
+    str
+
+    """
+
+    args = cmdargs.split()
+    if '-base' in args:
+        return 'recon_base'
+    if '-long' in args:
+        return 'recon_long'
+    if '-autorecon2-wm' in args:
+        return 'recon_edit'
+    return 'recon_all'
+
+def input_voxels(path: str) -> float:
+    """
+    Estimates the voxel count of a recon-all input.
+
+    Volumes that nibabel can read (nii, mgz) return the product of their
+    dimensions, read from the header only. For a DICOM file, rows times
+    columns of its header times the number of slices of the series
+    (ImagesInAcquisition, or the number of .dcm files in its folder) is
+    used, so both give the voxel count of the mri/orig/001.mgz that
+    recon-all creates from the input. Only one DICOM header is read.
+
+    Parameters
+    ----------
+    path : str
+        Path to the input dcm/nii/mgz file.
+
+    Returns
+    -------
+    float
+        Voxel count, or None if the input cannot be read.
+
+    """
+
+    if not os.path.isfile(path):
+        return None
+
+    if not path.lower().endswith('.dcm'):
+        try:
+            import nibabel as nib
+            return float(np.prod(nib.load(path).shape[:3]))
+        except Exception:
+            return None
+
+    try:
+        from scripts.dicom_index import read_header
+        header = read_header(path)
+    except ImportError:
+        return None
+    if not header.get('Rows') or not header.get('Columns'):
+        return None
+    slices = header.get('ImagesInAcquisition')
+    if not slices:
+        try:
+            # Directory entries only, the files are not opened or stat-ed
+            with os.scandir(os.path.dirname(path) or '.') as entries:
+                slices = sum(1 for entry in entries if entry.name.lower().endswith('.dcm'))
+        except OSError:
+            return None
+    return float(header['Rows'] * header['Columns'] * slices)
+
+def job_feature(job: "Job", subjects_dir: str = None) -> float:
+    """
+    Returns the model feature of a job.
+
+    Parameters
+    ----------
+    job : Job
+        Job to evaluate.
+    subjects_dir : str, default=None
+        FreeSurfer SUBJECTS_DIR. If None, the SUBJECTS_DIR environment
+        variable (default: FS_OUTPUTS) is used.
+
+    Returns
+    -------
+    float
+        Number of time points for recon-all [BASE]. Otherwise the voxel
+        count of the input (-i) for recon-all [CROSS], of the time point
+        mri/orig/001.mgz for recon-all [LONG], or of the subject
+        mri/orig/001.mgz for other recon-all runs (-s), the same feature as
+        collect_history. None if it cannot be read.
+
+    """
+
+    subjects_dir = subjects_dir or os.environ.get('SUBJECTS_DIR', 'FS_OUTPUTS')
+    if job.stage == 'recon_base':
+        return float(job.argv.count('-tp'))
+    for flag in ('-i', '-long', '-s'):
+        if flag in job.argv[:-1]:
+            value = job.argv[job.argv.index(flag) + 1]
+            if flag == '-i':
+                return input_voxels(value)
+            return input_voxels(os.path.join(subjects_dir, value, 'mri', 'orig', '001.mgz'))
+    return None
+
+def collect_history(subjects_dir: str) -> pd.DataFrame:
+    """
+    Collects wall times from a SUBJECTS_DIR.
+
+    Each subject folder with a scripts/recon-all.done file (or a
+    recon-all.log with a run time) is turned into one record.
+
+    Parameters
+    ----------
+    subjects_dir : str
+        FreeSurfer SUBJECTS_DIR.
+
+    Returns
+    -------
+    pd.DataFrame
+        History records, see HISTORY_COLUMNS.
+
+    """
+
+    records = list()
+    now = time.time()
+    with os.scandir(subjects_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.name == 'fsaverage':
+                continue
+            scripts = os.path.join(entry.path, 'scripts')
+            done = parse_done_file(os.path.join(scripts, 'recon-all.done'))
+            hours = done.get('RUNTIME_HOURS')
+            if hours is None:
+                hours = parse_log_runtime(os.path.join(scripts, 'recon-all.log'))
+            if hours is None:
+                continue
+
+            stage = stage_from_args(done.get('CMDARGS', ''))
+            if '.long.' in entry.name:
+                stage = 'recon_long'
+            elif os.path.isfile(os.path.join(entry.path, 'base-tps')):
+                stage = 'recon_base'
+
+            if stage == 'recon_base':
+                # The feature of a base is its number of time points, skip bases without base-tps
+                try:
+                    with open(os.path.join(entry.path, 'base-tps')) as f:
+                        feature = float(len(f.read().split()))
+                except FileNotFoundError:
+                    continue
+            else:
+                # [LONG] folders have no input of their own, their time point has
+                feature = input_voxels(os.path.join(subjects_dir, entry.name.split('.long.')[0], 'mri', 'orig', '001.mgz'))
+
+            records.append({'name': entry.name, 'subject': entry.name.split('.long.')[0], 'stage': stage,
+                            'wall_time': float(hours) * 3600, 'feature': feature, 'source': 'subjects_dir', 'recorded': now})
+
+    return pd.DataFrame(records, columns=HISTORY_COLUMNS)
+
+def read_history(path: str) -> pd.DataFrame:
+    """
+    Reads the history file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the tab separated history file.
+
+    Returns
+    -------
+    pd.DataFrame
+        History records, empty if the file does not exist.
+
+    """
+
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+    return pd.read_csv(path, sep='\t', dtype={'name': str, 'subject': str, 'stage': str})
+
+def update_history(path: str, records: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds records to the history file.
+
+    Only the most recent record of each job name and stage is kept.
+
+    Parameters
+    ----------
+    path : str
+        Path to the tab separated history file.
+    records : pd.DataFrame
+        New records, see HISTORY_COLUMNS.
+
+    Returns
+    -------
+    pd.DataFrame
+        The updated history.
+
+    """
+
+    history = pd.concat([read_history(path), records[HISTORY_COLUMNS]], ignore_index=True)
+    history = history.drop_duplicates(subset=['name', 'stage'], keep='last')
+    history.to_csv(path, sep='\t', index=False, header=True)
+    return history
+
+def results_to_records(results: list) -> pd.DataFrame:
+    """
+    Converts the results of done jobs to history records, with their resource usage.
+
+    Parameters
+    ----------
+    results : list
+        List of JobResult objects.
+
+    Returns
+    -------
+    pd.DataFrame
+        History records, see HISTORY_COLUMNS.
+
+    """
+
+    records = [dict(result.usage, name=result.job.name, subject=result.job.subject, stage=result.job.stage,
+                    wall_time=result.wall_time, feature=job_feature(result.job), source='run', recorded=result.end)
+               for result in results if result.status == 'done' and result.attempts == 1]
+    return pd.DataFrame(records, columns=HISTORY_COLUMNS)
+
+
+class RuntimeModel:
+    """
+    Predicts job durations from the history.
+
+    For each stage with at least MIN_RECORDS records and a varying feature,
+    wall_time = intercept + slope * feature is fitted by least squares.
+    Stages with fewer records use the median wall time, and stages without
+    records use DEFAULT_HOURS.
+
+    Parameters
+    ----------
+    history : pd.DataFrame, default=None
+        History records, see HISTORY_COLUMNS.
+
+    """
+
+    def __init__(self, history: pd.DataFrame = None):
+        self.fits = dict()
+        self.medians = dict()
+        if history is not None and len(history):
+            self.fit(history)
+
+    def fit(self, history: pd.DataFrame):
+        """
+        Fits the per-stage models.
+
+        Parameters
+        ----------
+        history : pd.DataFrame
+            History records, see HISTORY_COLUMNS.
+
+        Returns
+        -------
+        None
+
+        """
+
+        for stage, records in history.groupby('stage'):
+            wall_time = records['wall_time'].astype(float)
+            self.medians[stage] = float(wall_time.median())
+            feature = pd.to_numeric(records['feature'], errors='coerce')
+            valid = feature.notna().to_numpy()
+            if valid.sum() < MIN_RECORDS or feature[valid].nunique() < 2:
+                continue
+            x = feature[valid].to_numpy(dtype=float)
+            y = wall_time[valid].to_numpy(dtype=float)
+            slope, intercept = np.polyfit(x, y, 1)
+            self.fits[stage] = (intercept, slope, x.min(), x.max())
+
+    def predict(self, stage: str, feature: float = None) -> float:
+        """
+        Predicts the duration of a job.
+
+        Parameters
+        ----------
+        stage : str
+            Processing stage.
+        feature : float, default=None
+            Model feature (see job_feature). Values outside the fitted range
+            are clipped to it.
+
+        Returns
+        -------
+        float
+            Predicted wall time in seconds.
+
+        """
+
+        if stage in self.fits and feature is not None and not np.isnan(feature):
+            intercept, slope, low, high = self.fits[stage]
+            prediction = intercept + slope * min(max(feature, low), high)
+            if prediction > 0:
+                return float(prediction)
+        if stage in self.medians:
+            return self.medians[stage]
+        return DEFAULT_HOURS.get(stage, 1.0) * 3600
+
+    def predict_job(self, job: "Job") -> float:
+        """
+        Predicts the duration of a job in seconds.
+
+        Parameters
+        ----------
+        job : Job
+            Job to evaluate.
+
+        Returns
+        -------
+        float
+
+        """
+
+        return self.predict(job.stage, job_feature(job))
@@ -0,0 +1,147 @@
+"""Durable journal of job state transitions used to resume interrupted runs.
+
+The journal is an append-only JSON lines file. One line is written (and
+flushed to disk) every time a job is started or finishes, so after a power
+loss or restart it tells which jobs are done, which failed and which were
+running when the run was interrupted.
+
+This file can also be imported as a module and contains the following
+functions and classes:
+
+    * Journal - appends job state transitions to the journal file.
+    * read_journal - returns the last known state of each job.
+    * prepare_resume - removes done jobs and cleans interrupted ones.
+
+"""
+
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+
+
+class Journal:
+    """
+    Appends job state transitions to the journal file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON lines journal.
+    append : bool, default=True
+        Keep the existing entries. If False the journal is truncated.
+
+    """
+
+    def __init__(self, path: str, append: bool = True):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a" if append else "w")
+
+    def record(self, job: "Job", state: str, **fields):
+        """
+        Writes a state transition of a job.
+
+        Parameters
+        ----------
+        job : Job
+            The job.
+        state : str
+            New state: "running", "done", "failed" or "skipped".
+        **fields
+            Additional values stored with the entry (attempt, returncode, ...).
+
+        Returns
+        -------
+        None
+
+        """
+
+        entry = {"time": time.time(), "name": job.name, "stage": job.stage, "subject": job.subject, "state": state}
+        entry.update(fields)
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """Closes the journal file."""
+        self.file.close()
+
+
+def read_journal(path: str) -> dict:
+    """
+    Returns the last known state of each job.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON lines journal.
+
+    Returns
+    -------
+    dict
+        Job name to its last journal entry. Empty if the journal does not
+        exist. A truncated last line (interrupted write) is ignored.
+
+    """
+
+    states = dict()
+    if not os.path.isfile(path):
+        return states
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            states[entry["name"]] = entry
+    return states
+
+
+def prepare_resume(jobs: list, states: dict, subjects_dir: str) -> list:
+    """
+    Removes done jobs and cleans interrupted ones.
+
+    Jobs that are done according to the journal are dropped. Jobs that were
+    running when the run was interrupted, or that failed, get their partial
+    outputs deleted (Job.clean) so they restart from scratch; for recon-all
+    jobs working on an existing subject, the stale IsRunning lock files are
+    removed instead.
+
+    Parameters
+    ----------
+    jobs : list
+        List of Job objects.
+    states : dict
+        Output of read_journal.
+    subjects_dir : str
+        FreeSurfer SUBJECTS_DIR.
+
+    Returns
+    -------
+    list
+        Jobs that still have to run.
+
+    """
+
+    remaining = list()
+    for job in jobs:
+        state = states.get(job.name, {}).get("state")
+        if state == "done":
+            continue
+        if state in ("running", "failed"):
+            print(f"Cleaning {state} job {job.name}")
+            if job.clean:
+                for path in job.clean:
+                    shutil.rmtree(path, ignore_errors=True)
+            elif job.argv[:1] == ["recon-all"]:
+                for lock in glob.glob(os.path.join(subjects_dir, job.subject, "scripts", "IsRunning*")):
+                    os.remove(lock)
+        remaining.append(job)
+    return remaining
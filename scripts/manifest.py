@@ -0,0 +1,246 @@
+"""Task manifests for recon-all [BASE] and [LONG] processing.
+
+A manifest is a table with one row per recon-all job and the columns:
+
+    * stage - recon_base or recon_long.
+    * subject - subject base ID.
+    * id - base ID (recon_base) or unique time point ID (recon_long).
+    * timepoints - space separated unique IDs of the time points of the base
+      (recon_base only).
+    * flags - additional recon-all flags (default: -all).
+
+Manifests are stored as tab separated files (.tsv, .txt) or as JSON lists of
+records (.json). The command line files recon_base_input.txt and
+recon_long_input.txt (one "recon-all ..." command per line) are still
+accepted and converted to a manifest when read.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * create_manifest - creates the manifest of the base and long jobs of each subject.
+    * write_manifest - writes a manifest.
+    * is_manifest - tells a manifest from a command line file.
+    * read_manifest - reads a manifest.
+    * manifest_from_commands - converts recon-all command lines to a manifest.
+    * read_tasks - reads a manifest or a command line file.
+    * task_name - returns the SUBJECTS_DIR folder name of a task.
+    * task_argv - returns the recon-all command of a task.
+
+"""
+
+import json
+import os
+import shlex
+import pandas as pd
+
+MANIFEST_COLUMNS = ['stage', 'subject', 'id', 'timepoints', 'flags']
+
+# Flags used when a task does not define any
+DEFAULT_FLAGS = '-all'
+
+def create_manifest(timepoints: list, flags: str = DEFAULT_FLAGS) -> pd.DataFrame:
+    """
+    Creates the manifest of the base and long jobs of each subject.
+
+    Parameters
+    ----------
+    timepoints : list
+        (subject, list of unique IDs sorted by visit) tuples.
+    flags : str, default="-all"
+        recon-all flags of every task.
+
+    Returns
+    -------
+    pd.DataFrame
+        One recon_base row per subject followed by one recon_long row per
+        time point.
+
+    """
+
+    rows = [{'stage': 'recon_base', 'subject': subject, 'id': subject, 'timepoints': ' '.join(ids), 'flags': flags}
+            for subject, ids in timepoints]
+    rows += [{'stage': 'recon_long', 'subject': subject, 'id': id, 'timepoints': '', 'flags': flags}
+             for subject, ids in timepoints for id in ids]
+    return pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+
+def write_manifest(manifest: pd.DataFrame, path: str):
+    """
+    Writes a manifest.
+
+    Parameters
+    ----------
+    manifest : pd.DataFrame
+        Manifest, see MANIFEST_COLUMNS.
+    path : str
+        Output file, JSON if it ends with .json, tab separated otherwise.
+
+    Returns
+    -------
+    None
+
+    """
+
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(manifest[MANIFEST_COLUMNS].to_dict(orient='records'), f, indent=1)
+    else:
+        manifest[MANIFEST_COLUMNS].to_csv(path, sep='\t', index=False, header=True)
+
+def is_manifest(path: str) -> bool:
+    """
+    Tells a manifest from a command line file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the input file.
+
+    Returns
+    -------
+    bool
+        True for .json and .tsv files, and for files whose first line is the
+        manifest header.
+
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.json', '.tsv'):
+        return True
+    with open(path) as f:
+        header = f.readline().rstrip('\r\n').split('\t')
+    return header[:2] == MANIFEST_COLUMNS[:2]
+
+def read_manifest(path: str, stage: str = None) -> pd.DataFrame:
+    """
+    Reads a manifest.
+
+    Parameters
+    ----------
+    path : str
+        Path to the manifest.
+    stage : str, default=None
+        Only keep the tasks of this stage (recon_base or recon_long).
+
+    Returns
+    -------
+    pd.DataFrame
+        Manifest with all MANIFEST_COLUMNS, missing values as empty strings
+        except flags, which default to DEFAULT_FLAGS.
+
+    """
+
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            manifest = pd.DataFrame(json.load(f), dtype=str)
+    else:
+        manifest = pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+    for column in MANIFEST_COLUMNS:
+        if column not in manifest:
+            manifest[column] = DEFAULT_FLAGS if column == 'flags' else ''
+    manifest = manifest[MANIFEST_COLUMNS].fillna('')
+    # Rows without flags get the same default as a manifest without a flags column
+    manifest.loc[manifest['flags'].str.strip() == '', 'flags'] = DEFAULT_FLAGS
+    if stage is not None:
+        manifest = manifest[manifest['stage'] == stage]
+    return manifest.reset_index(drop=True)
+
+def manifest_from_commands(path: str, stage: str) -> pd.DataFrame:
+    """
+    Converts recon-all command lines to a manifest.
+
+    Parameters
+    ----------
+    path : str
+        Path to recon_base_input.txt ("recon-all -base <subject> -tp <unique_id> ... -all")
+        or recon_long_input.txt ("recon-all -long <unique_id> <subject> -all").
+    stage : str
+        recon_base or recon_long.
+
+    Returns
+    -------
+    pd.DataFrame
+        Manifest, one row per non-empty line.
+
+    """
+
+    rows = list()
+    with open(path) as f:
+        for line in f:
+            argv = shlex.split(line)
+            if not argv:
+                continue
+            if stage == 'recon_base':
+                subject = argv[argv.index('-base') + 1]
+                timepoints = [argv[i + 1] for i, arg in enumerate(argv) if arg == '-tp']
+                flags = [arg for i, arg in enumerate(argv[1:], 1)
+                         if arg not in ('-base', '-tp') and argv[i - 1] not in ('-base', '-tp')]
+                rows.append({'stage': stage, 'subject': subject, 'id': subject, 'timepoints': ' '.join(timepoints), 'flags': ' '.join(flags)})
+            else:
+                position = argv.index('-long')
+                id, subject = argv[position + 1], argv[position + 2]
+                flags = argv[1:position] + argv[position + 3:]
+                rows.append({'stage': stage, 'subject': subject, 'id': id, 'timepoints': '', 'flags': ' '.join(flags)})
+    return pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+
+def read_tasks(path: str, stage: str) -> pd.DataFrame:
+    """
+    Reads a manifest or a command line file.
+
+    Parameters
+    ----------
+    path : str
+        Path to a manifest, recon_base_input.txt or recon_long_input.txt.
+    stage : str
+        recon_base or recon_long.
+
+    Returns
+    -------
+    pd.DataFrame
+        Tasks of the stage, see MANIFEST_COLUMNS.
+
+    """
+
+    if is_manifest(path):
+        return read_manifest(path, stage)
+    return manifest_from_commands(path, stage)
+
+def task_name(task: dict) -> str:
+    """
+    Returns the SUBJECTS_DIR folder name of a task.
+
+    Parameters
+    ----------
+    task : dict
+        Manifest row.
+
+    Returns
+    -------
+    str
+        <subject> for recon_base, <unique_id>.long.<subject> for recon_long.
+
+    """
+
+    if task['stage'] == 'recon_base':
+        return task['subject']
+    return f"{task['id']}.long.{task['subject']}"
+
+def task_argv(task: dict) -> list:
+    """
+    Returns the recon-all command of a task.
+
+    Parameters
+    ----------
+    task : dict
+        Manifest row.
+
+    Returns
+    -------
+    list
+        recon-all argv.
+
+    """
+
+    flags = shlex.split(task['flags'])
+    if task['stage'] == 'recon_base':
+        return ['recon-all', '-base', task['subject']] + [flag for id in task['timepoints'].split() for flag in ('-tp', id)] + flags
+    return ['recon-all', '-long', task['id'], task['subject']] + flags
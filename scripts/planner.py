@@ -0,0 +1,267 @@
+"""Dry-run planner for run.py sub-commands.
+
+The jobs of a sub-command are checked against the journal when resuming to
+find the ones already done, with the same rule as the run itself. recon-all
+jobs whose subject folder is already done in SUBJECTS_DIR are run again
+(and fail, recon-all does not overwrite a subject), so they are reported.
+The duration of the others is predicted from the runtime history, and the
+run is simulated with the dispatch rule of --order (ready jobs started on
+--parallel slots longest chain first, or in input order) to estimate its
+wall time.
+The critical path is the longest chain of dependent jobs, a lower bound of
+the wall time whatever the number of parallel runs.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * completed_jobs - finds the jobs that are already done.
+    * existing_subjects - finds the recon-all jobs whose subject is done.
+    * critical_path - returns the longest chain of dependent jobs.
+    * simulate - estimates the wall time of a list of jobs.
+    * plan_jobs - builds the plan of a run.
+    * print_plan - prints a plan.
+
+"""
+
+import heapq
+import os
+
+from scripts.resources import DEFAULT_COSTS, UNKNOWN_COST
+from scripts.status import STAGES, get_state, scan_subjects_dir
+
+def completed_jobs(jobs: list, states: dict = None) -> set:
+    """
+    Finds the jobs that are already done.
+
+    Only the journal is used, as in prepare_resume: a run without --resume
+    runs every job.
+
+    Parameters
+    ----------
+    jobs : list
+        List of Job objects.
+    states : dict, default=None
+        Output of read_journal. Jobs done according to it are done.
+
+    Returns
+    -------
+    set
+        Names of the done jobs.
+
+    """
+
+    states = states or dict()
+    return {job.name for job in jobs if states.get(job.name, {}).get("state") == "done"}
+
+def existing_subjects(jobs: list, index: dict) -> list:
+    """
+    Finds the recon-all jobs whose subject folder is already done.
+
+    Parameters
+    ----------
+    jobs : list
+        List of Job objects.
+    index : dict
+        Output of scan_subjects_dir. recon-all [CROSS], [BASE] and [LONG]
+        jobs are named after their subject folder.
+
+    Returns
+    -------
+    list
+        Names of the jobs.
+
+    """
+
+    return [job.name for job in jobs if job.argv[:1] == ["recon-all"] and job.stage in STAGES and get_state(index, job.name) == "done"]
+
+def _chains(jobs: list) -> tuple:
+    """Length of the longest chain starting at each job and the next job of that chain."""
+    names = {job.name for job in jobs}
+    dependents = {job.name: list() for job in jobs}
+    for job in jobs:
+        for dep in job.deps:
+            if dep in names:
+                dependents[dep].append(job)
+
+    rank = dict()
+    following = dict()
+
+    def chain(job, visiting=()):
+        if job.name not in rank:
+            if job.name in visiting:
+                return 0
+            tail = [(chain(dependent, visiting + (job.name,)), dependent) for dependent in dependents[job.name]]
+            length, dependent = max(tail, key=lambda item: item[0], default=(0, None))
+            rank[job.name] = job.duration + length
+            following[job.name] = dependent
+        return rank[job.name]
+
+    for job in jobs:
+        chain(job)
+    return rank, following
+
+def critical_path(jobs: list) -> list:
+    """
+    Returns the longest chain of dependent jobs.
+
+    Parameters
+    ----------
+    jobs : list
+        List of Job objects with their predicted duration set.
+
+    Returns
+    -------
+    list
+        Job objects of the chain, in dependency order.
+
+    """
+
+    if not jobs:
+        return []
+    rank, following = _chains(jobs)
+    job = max(jobs, key=lambda job: rank[job.name])
+    path = list()
+    while job is not None:
+        path.append(job)
+        job = following[job.name]
+    return path
+
+def simulate(jobs: list, parallel: int, order: str = "longest") -> float:
+    """
+    Estimates the wall time of a list of jobs.
+
+    Jobs are started as in Scheduler.run: as soon as their dependencies are
+    done and a slot is free, longest chain first, then in the given order.
+    Dependencies on jobs that are not part of the list are done already.
+
+    Parameters
+    ----------
+    jobs : list
+        List of Job objects with their predicted duration set.
+    parallel : int
+        Number of jobs running at the same time.
+    order : str, default="longest"
+        "longest" to start ready jobs longest chain first, "input" to start
+        them in the given order (run.py --order input leaves the duration of
+        the jobs unset, so the Scheduler ranks them all the same).
+
+    Returns
+    -------
+    float
+        Predicted wall time in seconds.
+
+    """
+
+    rank, _ = _chains(jobs)
+    names = {job.name for job in jobs}
+    waiting = {job.name: len([dep for dep in job.deps if dep in names]) for job in jobs}
+    dependents = {job.name: list() for job in jobs}
+    for job in jobs:
+        for dep in job.deps:
+            if dep in names:
+                dependents[dep].append(job)
+
+    if order == "input":
+        keys = {job.name: (index,) for index, job in enumerate(jobs)}
+    else:
+        keys = {job.name: (-rank[job.name], index) for index, job in enumerate(jobs)}
+    ready = [(keys[job.name], job.name, job) for job in jobs if waiting[job.name] == 0]
+    heapq.heapify(ready)
+    running = list()
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < max(1, parallel):
+            _, name, job = heapq.heappop(ready)
+            heapq.heappush(running, (now + job.duration, name, job))
+        now, _, job = heapq.heappop(running)
+        for dependent in dependents[job.name]:
+            waiting[dependent.name] -= 1
+            if waiting[dependent.name] == 0:
+                heapq.heappush(ready, (keys[dependent.name], dependent.name, dependent))
+    return now
+
+def plan_jobs(stages: list, subjects_dir: str, parallel: int, model: "RuntimeModel", costs: dict = None, states: dict = None, order: str = "longest") -> dict:
+    """
+    Builds the plan of a run.
+
+    Parameters
+    ----------
+    stages : list
+        Lists of Job objects, see build_jobs in run.py. Each list starts
+        after the previous one is finished.
+    subjects_dir : str
+        FreeSurfer SUBJECTS_DIR, scanned for done subjects of the jobs to run.
+    parallel : int
+        Number of jobs running at the same time.
+    model : RuntimeModel
+        Predicts the duration of each job. In-process actions take no time.
+    costs : dict, default=None
+        Cost per command type, see DEFAULT_COSTS. CPU-hours are the predicted
+        wall time times the declared threads of each job.
+    states : dict, default=None
+        Output of read_journal, when resuming.
+    order : str, default="longest"
+        Dispatch order of run.py --order, see simulate.
+
+    Returns
+    -------
+    dict
+        "jobs": total number of jobs, "done": names of the done jobs,
+        "existing": names of the recon-all jobs to run whose subject is done,
+        "stages": stage to {"jobs", "hours", "cpu_hours"} of the jobs to run,
+        "cpu_hours", "wall_time" (seconds) and "critical_path" (Job objects).
+
+    """
+
+    costs = costs or DEFAULT_COSTS
+    index = scan_subjects_dir(subjects_dir) if os.path.isdir(subjects_dir) else dict()
+    done = completed_jobs([job for jobs in stages for job in jobs], states)
+
+    plan = {"jobs": sum(len(jobs) for jobs in stages), "done": sorted(done), "existing": list(), "stages": dict(),
+            "cpu_hours": 0.0, "wall_time": 0.0, "critical_path": list()}
+    for jobs in stages:
+        jobs = [job for job in jobs if job.name not in done]
+        plan["existing"].extend(existing_subjects(jobs, index))
+        for job in jobs:
+            job.duration = 0.0 if job.action is not None else model.predict_job(job)
+            command = os.path.basename(job.argv[0]) if job.argv else None
+            threads = costs.get(command, UNKNOWN_COST)["threads"]
+            summary = plan["stages"].setdefault(job.stage, {"jobs": 0, "hours": 0.0, "cpu_hours": 0.0})
+            summary["jobs"] += 1
+            summary["hours"] += job.duration / 3600
+            summary["cpu_hours"] += job.duration * threads / 3600
+        plan["wall_time"] += simulate(jobs, parallel, order)
+        plan["critical_path"].extend(critical_path(jobs))
+    plan["cpu_hours"] = sum(summary["cpu_hours"] for summary in plan["stages"].values())
+    return plan
+
+def print_plan(plan: dict, parallel: int):
+    """
+    Prints a plan.
+
+    Parameters
+    ----------
+    plan : dict
+        Output of plan_jobs.
+    parallel : int
+        Number of jobs running at the same time.
+
+    Returns
+    -------
+    None
+
+    """
+
+    print(f"{plan['jobs']} jobs, {len(plan['done'])} already done, {plan['jobs'] - len(plan['done'])} to run")
+    if plan["existing"]:
+        print(f"WARNING: {len(plan['existing'])} recon-all jobs to run have a done subject folder in SUBJECTS_DIR: {', '.join(plan['existing'][:5])}{' ...' if len(plan['existing']) > 5 else ''}")
+    print(f"{'stage':<18}{'jobs':>8}{'hours':>12}{'CPU-hours':>12}")
+    for stage, summary in plan["stages"].items():
+        print(f"{stage:<18}{summary['jobs']:>8}{summary['hours']:>12.1f}{summary['cpu_hours']:>12.1f}")
+    print("")
+    print(f"Total: {plan['cpu_hours']:.1f} CPU-hours, estimated wall time {plan['wall_time'] / 3600:.1f} h with {parallel} parallel runs")
+    if plan["critical_path"]:
+        length = sum(job.duration for job in plan["critical_path"])
+        print(f"Critical path: {length / 3600:.1f} h")
+        for job in plan["critical_path"]:
+            print(f"  {job.name} ({job.stage}, {job.duration / 3600:.1f} h)")
@@ -1,124 +1,172 @@
 """
-This module provides a function to check the SNR of the white and gray matter
+This module provides functions to check the SNR of the white and gray matter
 
 """
 
 # -----------------------------------------------------------------------------
 
-def checkSNR(subjects_dir, subject, nb_erode=3, ref_image="norm.mgz", aparc_image="aparc+aseg.mgz"):
+def checkSNRs(subjects_dir, subject, nb_erode=3, ref_images=["orig.mgz", "norm.mgz"], aparc_image="aparc+aseg.mgz", label_sets=None, subject_data=None):
     """
-    A function to check the SNR of the white and gray matter.
+    A function to check the SNR of the white and gray matter for several
+    reference images.
 
-    This function checks the SNR of the white and the gray matter. The white
-    matter segmentation is taken from the aparc+aseg image and the gray matter
-    from the aseg image. The white matter is eroded by three voxels in order to
-    ignore partial volumes. For the gray matter this is not possible, because
-    the layer is aready very thin. An erosion would eliminate nearly the whole
-    signal.
+    This function checks the SNR of the white and the gray matter, like
+    checkSNR, but for a list of reference images. The white and gray matter
+    masks, including the erosion of the white matter, are computed only once
+    and used for all reference images.
+
+    Additional masks can be given as label sets, e.g. the white matter of a
+    single lobe from the wmparc image. Their SNR is computed for all reference
+    images as well.
 
     Required arguments:
         - subjects_dir : path to the subjects directory
         - subject : subject ID
 
     Optional arguments:
-        - nb_erode : the number of erosions, default = 3
-        - ref_image : the reference image, default = "norm.mgz", can be changed
-          to "orig.mgz"
+        - nb_erode : the number of erosions of the white matter, default = 3
+        - ref_images : a list of reference images, default = ["orig.mgz",
+          "norm.mgz"]
         - aparc_image : the aparc+aseg image, default = "aparc+aseg.mgz", can
           be changed to "aparc+aseg.orig.mgz" for FastSurfer output
+        - label_sets : a dictionary of additional masks, default = None; the
+          keys are names and the values are tuples of a label image, a list of
+          labels, and the number of erosions (0 for none), e.g.
+          { "wm_frontal_lh" : ("wmparc.mgz", [3003, 3027, 3028], 3) }
+        - subject_data : a SubjectData object, default = None; if given, the
+          volumes it has already loaded for the subject are reused
 
     Returns:
-        - wm_snr, gm_snr
+        - a dictionary with the reference images as keys, and dictionaries
+          with the keys "wm", "gm", and the names of the label sets as values
 
-    Requires valid mri/norm.mgz, mri/aseg.mgz, and mri/aparc+aseg.mgz files for
-    FreeSurfer output, and valid mri/norm.mgz, mri/aseg.mgz, and
-    mri/aparc+aseg.orig.mgz files for FastSurfer output.
-    If not found, NaNs will be returned.
+    Requires valid mri/aseg.mgz and mri/aparc+aseg.mgz files for FreeSurfer
+    output, and valid mri/aseg.mgz and mri/aparc+aseg.orig.mgz files for
+    FastSurfer output, as well as the reference images and the label images of
+    the label sets. If not found, NaNs will be returned for the masks or
+    reference images concerned. The images can have any dimensions, but must
+    have the same dimensions.
 
     """
 
     # Imports
 
-    import os
     import numpy as np
-    import nibabel as nib
-    from skimage.morphology import binary_erosion
+    from qatoolspython.qatoolspythonUtils import binaryErosion
+    from qatoolspython.subjectData import SubjectData
 
-    # Message
+    # Get data (in their native data type, labels are integers)
 
-    print("Computing white and gray matter SNR for "+ref_image+" ...")
+    if subject_data is None:
+        subject_data = SubjectData(subjects_dir, subject)
 
-    # Get data
+    if label_sets is None:
+        label_sets = dict()
 
-    try:
-        path_reference_image = os.path.join(subjects_dir,subject,"mri",ref_image)
-        norm = nib.load(path_reference_image)
-        norm_data = norm.get_fdata()
-    except FileNotFoundError:
-        print("WARNING: could not open "+path_reference_image+", returning NaNs.")
-        return np.nan, np.nan
+    # The following keys represent the white matter labels in the aparc+aseg
+    # image and the gray matter labels in the aseg image
+    wm_labels = [2, 41, 7, 46, 251, 252, 253, 254, 255, 77, 78, 79]
+    gm_labels = [ 3, 42 ]
 
-    try:
-        path_aseg = os.path.join(subjects_dir,subject,"mri","aseg.mgz")
-        aseg = nib.load(path_aseg)
-        data_aseg = aseg.get_fdata()
-    except FileNotFoundError:
-        print("WARNING: could not open "+path_aseg+", returning NaNs.")
-        return np.nan, np.nan
+    # Masks: the wm mask is eroded in order to ignore partial volumes. For the
+    # gray matter this is not possible, because the layer is aready very thin.
+    # An erosion would eliminate nearly the whole signal.
+    mask_sets = { "wm" : (aparc_image, wm_labels, nb_erode), "gm" : ("aseg.mgz", gm_labels, 0) }
+    mask_sets.update(label_sets)
 
-    try:
-        path_aparc_aseg  = os.path.join(subjects_dir,subject,"mri",aparc_image)
-        inseg = nib.load(path_aparc_aseg)
-        data_aparc_aseg = inseg.get_fdata()
-    except FileNotFoundError:
-        print("WARNING: could not open "+path_aparc_aseg+", returning NaNs.")
-        return np.nan, np.nan
+    # Create binary masks of the labels, None if the label image is missing
+    masks = dict()
+    for name, (label_image, labels, erode) in mask_sets.items():
+        try:
+            data_labels = subject_data.data(label_image)
+        except FileNotFoundError:
+            print("WARNING: could not open "+subject_data.path(label_image)+", returning NaNs.")
+            masks[name] = None
+            continue
+        masks[name] = np.isin(data_labels, labels)
+        if erode > 0:
+            masks[name] = binaryErosion(masks[name], erode)
 
-    # Process white matter image
+    # Computation of the SNR for each reference image
 
-    # Create 3D binary data where the white matter locations are encoded with 1, all the others with zero
-    b_wm_data = np.zeros((256,256,256))
+    snrs = dict()
 
-    # The following keys represent the white matter labels in the aparc+aseg image
-    wm_labels = [2, 41, 7, 46, 251, 252, 253, 254, 255, 77, 78, 79]
+    for ref_image in ref_images:
 
-    # Find the wm labels in the aparc+aseg image and set the locations in the binary image to one
-    for i in wm_labels:
-        x, y, z = np.where(data_aparc_aseg == i)
-        b_wm_data[x,y,z] = 1
+        # Message
+        print("Computing white and gray matter SNR for "+ref_image+" ...")
 
-    # Erode white matter image
-    nb_erode = nb_erode
-    b_wm_data = binary_erosion(b_wm_data,np.ones((nb_erode, nb_erode,nb_erode)))
+        snrs[ref_image] = dict.fromkeys(mask_sets.keys(), np.nan)
 
-    # Computation of the SNR of the white matter
-    x, y, z = np.where(b_wm_data == 1)
-    signal_wm = norm_data[x,y,z]
-    signal_wm_mean = np.mean(signal_wm)
-    signal_wm_std = np.std(signal_wm)
-    wm_snr = signal_wm_mean/signal_wm_std
-    print("White matter signal to noise ratio:", '{:.4}'.format(wm_snr))
+        try:
+            path_reference_image = subject_data.path(ref_image)
+            norm_data = subject_data.data(ref_image)
+        except FileNotFoundError:
+            print("WARNING: could not open "+path_reference_image+", returning NaNs.")
+            continue
 
-    # Process gray matter image
+        for name, mask in masks.items():
 
-    # Create 3D binary data where the gray matter locations are encoded with 1, all the others with zero
-    b_gm_data = np.zeros((256,256,256))
+            if mask is None:
+                continue
 
-    # The following keys represent the gray matter labels in the aseg image
-    gm_labels = [ 3, 42 ]
+            if mask.shape != norm_data.shape:
+                print("WARNING: "+path_reference_image+" and "+subject_data.path(mask_sets[name][0])+" have different dimensions, returning NaNs.")
+                continue
+
+            signal = norm_data[mask].astype(np.float64)
+            signal_mean = np.mean(signal)
+            signal_std = np.std(signal)
+            snrs[ref_image][name] = signal_mean/signal_std
+
+        print("White matter signal to noise ratio:", '{:.4}'.format(snrs[ref_image]["wm"]))
+        print("Gray matter signal to noise ratio:", '{:.4}'.format(snrs[ref_image]["gm"]))
+        for name in label_sets.keys():
+            print("Signal to noise ratio of "+name+":", '{:.4}'.format(snrs[ref_image][name]))
+
+    # Return
+    return snrs
+
+# -----------------------------------------------------------------------------
+
+def checkSNR(subjects_dir, subject, nb_erode=3, ref_image="norm.mgz", aparc_image="aparc+aseg.mgz", subject_data=None):
+    """
+    A function to check the SNR of the white and gray matter.
 
-    # Find the gm labels in the aseg image and set the locations in the binary image to one
-    for i in gm_labels:
-        x, y, z = np.where(data_aseg == i)
-        b_gm_data[x, y, z] = 1
+    This function checks the SNR of the white and the gray matter. The white
+    matter segmentation is taken from the aparc+aseg image and the gray matter
+    from the aseg image. The white matter is eroded by three voxels in order to
+    ignore partial volumes. For the gray matter this is not possible, because
+    the layer is aready very thin. An erosion would eliminate nearly the whole
+    signal.
+
+    Use checkSNRs to check several reference images at once.
+
+    Required arguments:
+        - subjects_dir : path to the subjects directory
+        - subject : subject ID
+
+    Optional arguments:
+        - nb_erode : the number of erosions, default = 3
+        - ref_image : the reference image, default = "norm.mgz", can be changed
+          to "orig.mgz"
+        - aparc_image : the aparc+aseg image, default = "aparc+aseg.mgz", can
+          be changed to "aparc+aseg.orig.mgz" for FastSurfer output
+        - subject_data : a SubjectData object, default = None; if given, the
+          volumes it has already loaded for the subject are reused
+
+    Returns:
+        - wm_snr, gm_snr
+
+    Requires valid mri/norm.mgz, mri/aseg.mgz, and mri/aparc+aseg.mgz files for
+    FreeSurfer output, and valid mri/norm.mgz, mri/aseg.mgz, and
+    mri/aparc+aseg.orig.mgz files for FastSurfer output.
+    If not found, NaNs will be returned. The images can have any dimensions,
+    but must have the same dimensions.
+
+    """
 
-    # Computation of the SNR of the gray matter
-    x, y, z = np.where(b_gm_data == 1)
-    signal_gm = norm_data[x,y,z]
-    signal_gm_mean = np.mean(signal_gm)
-    signal_gm_std = np.std(signal_gm)
-    gm_snr =signal_gm_mean/signal_gm_std
-    print ("Gray matter signal to noise ratio:", '{:.4}'.format(gm_snr))
+    snrs = checkSNRs(subjects_dir, subject, nb_erode=nb_erode, ref_images=[ref_image], aparc_image=aparc_image, subject_data=subject_data)
 
     # Return
-    return wm_snr, gm_snr
+    return snrs[ref_image]["wm"], snrs[ref_image]["gm"]
@@ -20,7 +20,7 @@ def checkTopology(subjects_dir, subject):
         - lh_holes, rh_holes, lh_defects, rh_defects, topo_time_lh, topo_time_rh
 
     Requires valid scripts/recon-all.log file. If not found, NaNs will be
-    returned.
+    returned. The log is parsed with the incremental ReconAllLogReader.
 
     """
 
@@ -28,67 +28,43 @@ def checkTopology(subjects_dir, subject):
 
     import os
     import numpy as np
+    from qatoolspython.reconAllLog import ReconAllLogReader
 
     # Message
 
     print("Checking topology of the surfaces ...")
 
-    # Get the logfile, and return with NaNs if unsuccessful:
+    # Parse the logfile, and return with NaNs if unsuccessful:
 
     path_log_file = os.path.join(subjects_dir,subject,"scripts","recon-all.log")
 
+    reader = ReconAllLogReader()
+
     try:
-        with open(path_log_file, 'r') as logfile:
-            lines_log_file = logfile.read().splitlines()
+        events = reader.read(path_log_file)
     except FileNotFoundError:
             print("WARNING: could not find "+path_log_file+", returning NaNs.")
             return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
-    
-    # Initialize
-
-    lh_holes = np.nan
-    rh_holes = np.nan
-    lh_defects = np.nan
-    rh_defects = np.nan
-    topo_time_lh = np.nan
-    topo_time_rh = np.nan
-
-    # Extract info from logfile
-
-    foundDefectsLH = False
-    foundTopoLH = False
-
-    for line_log_file in lines_log_file:
-
-        # Look for the number of holes in the left and right hemisphere
-        if "orig.nofix lhholes" in line_log_file:
-            lh_holes = line_log_file.split()[3]
-            lh_holes = lh_holes[:-1]
-            lh_holes = int(lh_holes)
-            rh_holes = line_log_file.split()[6]
-            print("Number of holes in the left hemisphere:", lh_holes)
-            print("Number of holes in the right hemisphere:", rh_holes)
-
-        # Look for the number of defects
-        if "defects found" in line_log_file and foundDefectsLH is False :
-            lh_defects = line_log_file.split()[0]
-            lh_defects = int(lh_defects)
-            print("Number of defects in the left hemisphere:", lh_defects)
-            foundDefectsLH = True
-        elif "defects found" in line_log_file and foundDefectsLH is True :
-            rh_defects = line_log_file.split()[0]
-            rh_defects = int(rh_defects)
-            print("Number of defects in the right hemisphere:", rh_defects)
-
-        # Look for the topological fixing time in the log file
-        if "topology fixing took" in line_log_file and foundTopoLH is False:
-            topo_time_lh = line_log_file.split()[3]
-            print("Topological fixing time for the left hemisphere:", topo_time_lh, "min")
-            foundTopoLH = True
-        elif "topology fixing took" in line_log_file and foundTopoLH is True:
-            topo_time_rh = line_log_file.split()[3]
-            print("Topological fixing time for the right hemisphere:", topo_time_rh, "min")
+
+    # Extract info from log events
+
+    for event in events:
+
+        # Number of holes in the left and right hemisphere
+        if event['type'] == 'holes':
+            print("Number of holes in the left hemisphere:", event['lh'])
+            print("Number of holes in the right hemisphere:", event['rh'])
+
+        # Number of defects
+        elif event['type'] == 'defects':
+            print("Number of defects in the "+("left" if event['hemi'] == 'lh' else "right")+" hemisphere:", event['count'])
+
+        # Topological fixing time
+        elif event['type'] == 'topology_time':
+            print("Topological fixing time for the "+("left" if event['hemi'] == 'lh' else "right")+" hemisphere:", event['minutes'], "min")
+
+    summary = reader.summary(path_log_file)
 
     # Return
 
-    return lh_holes, rh_holes, lh_defects, rh_defects, topo_time_lh, topo_time_rh
+    return summary['lh_holes'], summary['rh_holes'], summary['lh_defects'], summary['rh_defects'], summary['topo_time_lh'], summary['topo_time_rh']
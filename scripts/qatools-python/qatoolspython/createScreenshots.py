@@ -7,7 +7,7 @@ This module provides a function to create screenshots
 
 def createScreenshots(SUBJECT, SUBJECTS_DIR, OUTFILE, INTERACTIVE = True, LAYOUT = None,
     BASE = ["default"], OVERLAY = ["default"], SURF = ["default"], SURFCOLOR = ["default"],
-    VIEWS = ["default"]
+    VIEWS = ["default"], SUBJECT_DATA = None
     ):
 
     """
@@ -19,6 +19,11 @@ def createScreenshots(SUBJECT, SUBJECTS_DIR, OUTFILE, INTERACTIVE = True, LAYOUT
 
     OVERLAY, SURF, SURFCOLOR can be lists or None, can be ["default"]
 
+    SUBJECT_DATA can be a SubjectData object, which is then used to get the
+    default BASE and OVERLAY images, so that volumes already loaded by other
+    modules are not read again
+
+
     """
 
     # -----------------------------------------------------------------------------
@@ -49,6 +54,7 @@ def createScreenshots(SUBJECT, SUBJECTS_DIR, OUTFILE, INTERACTIVE = True, LAYOUT
 
     from matplotlib import pyplot as plt
     from qatoolspython.qatoolspythonUtils import levelsetsTria
+    from qatoolspython.subjectData import SubjectData
 
     # -----------------------------------------------------------------------------
     # settings
@@ -64,17 +70,24 @@ def createScreenshots(SUBJECT, SUBJECTS_DIR, OUTFILE, INTERACTIVE = True, LAYOUT
     # -----------------------------------------------------------------------------
     # import image data
 
+    if SUBJECT_DATA is None:
+        SUBJECT_DATA = SubjectData(SUBJECTS_DIR, SUBJECT)
+
     if BASE == ["default"]:
-        norm = nb.load(os.path.join(SUBJECTS_DIR, SUBJECT, 'mri', 'norm.mgz'))
+        norm = SUBJECT_DATA.image('norm.mgz')
+        normData = SUBJECT_DATA.data('norm.mgz')
     else:
         norm = nb.load(BASE[0])
+        normData = norm.get_data()
 
     if OVERLAY is None:
         aseg = None
     elif OVERLAY == ["default"]:
-        aseg = nb.load(os.path.join(SUBJECTS_DIR, SUBJECT, 'mri', 'aseg.mgz'))
+        aseg = SUBJECT_DATA.image('aseg.mgz')
+        asegData = SUBJECT_DATA.data('aseg.mgz')
     else:
         aseg = nb.load(OVERLAY[0])
+        asegData = aseg.get_data()
 
     # -----------------------------------------------------------------------------
     # import surface data
@@ -161,8 +174,6 @@ def createScreenshots(SUBJECT, SUBJECTS_DIR, OUTFILE, INTERACTIVE = True, LAYOUT
     # -----------------------------------------------------------------------------
     # get data for norm
 
-    normData = norm.get_data()
-
     normVals = normData
 
     # -----------------------------------------------------------------------------
@@ -171,8 +182,6 @@ def createScreenshots(SUBJECT, SUBJECTS_DIR, OUTFILE, INTERACTIVE = True, LAYOUT
 
     if aseg is not None:
 
-        asegData = aseg.get_data()
-
         asegUnique, asegIdx = np.unique(asegData, return_inverse=True)
 
         asegEnum = np.array([lutEnum[x] for x in asegUnique])
@@ -130,7 +130,7 @@ def get_help(print_help=True, return_help=False):
         python3 qatools.py --subjects_dir <directory> --output_dir <directory>
                                   [--subjects SubjectID [SubjectID ...]]
                                   [--screenshots] [--fornix] [--shape]
-                                  [--outlier] [--fastsurfer] [-h]
+                                  [--outlier] [--fastsurfer] [--jobs N] [-h]
 
         required arguments:
           --subjects_dir <directory>
@@ -149,6 +149,8 @@ def get_help(print_help=True, return_help=False):
           --outlier-table       specify normative values (only in conjunction with
                                 --outlier)
           --fastsurfer          use FastSurfer instead of FreeSurfer output
+          --jobs N              number of subjects processed in parallel
+                                (default: 1)
 
         getting help:
           -h, --help            display this help message and exit
@@ -244,8 +246,8 @@ def get_help(print_help=True, return_help=False):
 
     A Python version >= 3.5 is required to run this script.
 
-    Required packages include (among others) the nibabel and skimage package for
-    the core functionality, plus the the matplotlib, pandas, and transform3d
+    Required packages include (among others) the nibabel package for the core
+    functionality, plus the the matplotlib, pandas, and transform3d
     packages for some optional functions and modules. See the `requirements.txt`
     file for a complete list. Use `pip3 install -r requirements.txt` to install
     these packages.
@@ -314,6 +316,7 @@ def _parse_arguments():
     optional.add_argument('--outlier', dest='outlier', help="run outlier detection", default=False, action="store_true", required=False)
     optional.add_argument('--outlier-table', dest="outlier_table", help="specify normative values", default=None, metavar="<filename>", required=False)
     optional.add_argument('--fastsurfer', dest='fastsurfer', help="use FastSurfer output", default=False, action="store_true", required=False)
+    optional.add_argument('--jobs', dest='jobs', help="number of subjects processed in parallel \n(default: 1)", default=1, type=int, metavar="N", required=False)
 
     help = parser.add_argument_group('getting help')
     help.add_argument('-h', '--help', help="display this help message and exit", action='help')
@@ -327,7 +330,7 @@ def _parse_arguments():
     return args.subjects_dir, args.output_dir, args.subjects, args.shape, \
         args.screenshots, args.screenshots_base, args.screenshots_overlay, \
         args.screenshots_surf, args.screenshots_views, args.fornix, \
-        args.outlier, args.outlier_table, args.fastsurfer
+        args.outlier, args.outlier_table, args.fastsurfer, args.jobs
 
 # ------------------------------------------------------------------------------
 # check arguments
@@ -708,10 +711,6 @@ def _check_packages():
         print('\nERROR: Python version must be 3.5 or greater\n')
         sys.exit(1)
 
-    if importlib.util.find_spec("skimage") is None:
-        print('\nERROR: the \'skimage\' package is required for running this script, please install.\n')
-        sys.exit(1)
-
     if importlib.util.find_spec("nibabel") is None:
         print('\nERROR: the \'nibabel\' package is required for running this script, please install.\n')
         sys.exit(1)
@@ -723,30 +722,35 @@ def _check_packages():
 
 
 # ------------------------------------------------------------------------------
-# do qatools
+# do qatools for a single subject
 
-def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=False, screenshots_base=["default"], screenshots_overlay=["default"], screenshots_surf=["default"], screenshots_views=["default"], fornix=False, outlier=False, outlier_table=None, fastsurfer=False):
+def _do_qatools_subject(subject, subjects_dir, output_dir, shape=False, screenshots=False, screenshots_base=["default"], screenshots_overlay=["default"], screenshots_surf=["default"], screenshots_views=["default"], fornix=False, fastsurfer=False, capture=False):
     """
-    an internal function to run the qatools submodules
+    an internal function to run the qatools submodules for a single subject
+
+    returns the subject ID, a dictionary with the metrics of the subject, a
+    list of the fieldnames added by the optional modules, and the messages of
+    the subject if capture is True (used when subjects are processed in
+    parallel, so that messages are not interleaved)
 
     """
 
     # ------------------------------------------------------------------------------
     # imports
 
+    import io
     import os
-    import csv
     import time
+    import contextlib
 
-    from qatoolspython.checkSNR import checkSNR
+    from qatoolspython.checkSNR import checkSNRs
     from qatoolspython.checkCCSize import checkCCSize
     from qatoolspython.checkTopology import checkTopology
     from qatoolspython.checkContrast import checkContrast
     from qatoolspython.checkRotation import checkRotation
     from qatoolspython.evaluateFornixSegmentation import evaluateFornixSegmentation
     from qatoolspython.createScreenshots import createScreenshots
-    from qatoolspython.outlierDetection import outlierTable
-    from qatoolspython.outlierDetection import outlierDetection
+    from qatoolspython.subjectData import SubjectData
 
     # ------------------------------------------------------------------------------
     # internal settings (might be turned into command-line arguments in the future)
@@ -755,7 +759,6 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
     FORNIX_SCREENSHOT = True
     FORNIX_SHAPE = False
     FORNIX_N_EIGEN = 15
-    OUTLIER_N_MIN = 5
 
     SHAPE_EVEC = False
     SHAPE_SKIPCORTEX = False
@@ -767,15 +770,17 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
     # --------------------------------------------------------------------------
     # process
 
-    # start the processing with a message
-    print("")
-    print("-----------------------------")
+    # messages are collected and returned instead of printed if requested
+    messages = io.StringIO()
+    if capture is True:
+        output = contextlib.redirect_stdout(messages)
+    else:
+        output = contextlib.ExitStack()
 
-    # create dict for this subject
-    metricsDict = dict()
+    # fieldnames of the optional modules
+    optionalFieldnames = list()
 
-    # loop through the specified subjects
-    for subject in subjects:
+    with output:
 
         #
         print("Starting qatools-python for subject", subject, "at", time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(time.time())))
@@ -789,14 +794,16 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
         else:
             aparc_image = "aparc+aseg.mgz"
 
+        # volumes are loaded once per subject and shared between the modules
+        subjectData = SubjectData(subjects_dir, subject)
+
         # ----------------------------------------------------------------------
         # compute core metrics
 
-        # get WM and GM SNR for orig.mgz
-        wm_snr_orig, gm_snr_orig = checkSNR(subjects_dir, subject, SNR_AMOUT_EROSION, ref_image="orig.mgz", aparc_image=aparc_image)
-
-        # get WM and GM SNR for norm.mgz
-        wm_snr_norm, gm_snr_norm = checkSNR(subjects_dir, subject, SNR_AMOUT_EROSION, ref_image="norm.mgz", aparc_image=aparc_image)
+        # get WM and GM SNR for orig.mgz and norm.mgz (the masks are computed once)
+        snrs = checkSNRs(subjects_dir, subject, SNR_AMOUT_EROSION, ref_images=["orig.mgz", "norm.mgz"], aparc_image=aparc_image, subject_data=subjectData)
+        wm_snr_orig, gm_snr_orig = snrs["orig.mgz"]["wm"], snrs["orig.mgz"]["gm"]
+        wm_snr_norm, gm_snr_norm = snrs["norm.mgz"]["wm"], snrs["norm.mgz"]["gm"]
 
         # check CC size
         cc_size = checkCCSize(subjects_dir, subject)
@@ -811,7 +818,7 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
         rot_tal_x, rot_tal_y, rot_tal_z = checkRotation(subjects_dir, subject)
 
         # store data
-        metricsDict.update( { subject : {
+        metrics = {
             'subject' : subject,
             'wm_snr_orig': wm_snr_orig, 'gm_snr_orig' : gm_snr_orig,
             'wm_snr_norm' : wm_snr_norm, 'gm_snr_norm' : gm_snr_norm,
@@ -819,7 +826,7 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
             'holes_lh' : holes_lh, 'holes_rh' : holes_rh, 'defects_lh' : defects_lh, 'defects_rh' : defects_rh, 'topo_lh' : topo_lh, 'topo_rh' : topo_rh,
             'con_snr_lh' : con_snr_lh, 'con_snr_rh' : con_snr_rh,
             'rot_tal_x' : rot_tal_x, 'rot_tal_y' : rot_tal_y , 'rot_tal_z' : rot_tal_z
-            }})
+            }
 
         #
         print("")
@@ -847,7 +854,8 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
             distDict = { subject : dstMat }
 
             # store data
-            metricsDict[subject].update(distDict[subject])
+            metrics.update(distDict[subject])
+            optionalFieldnames.extend(distDict[subject].keys())
 
         # ----------------------------------------------------------------------
         # run optional modules: screenshots
@@ -866,7 +874,7 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
             outfile = os.path.join(screenshots_outdir,subject+'.png')
 
             # process
-            createScreenshots(SUBJECT=subject, SUBJECTS_DIR=subjects_dir, OUTFILE=outfile, INTERACTIVE=False, BASE=screenshots_base, OVERLAY=screenshots_overlay, SURF=screenshots_surf, VIEWS=screenshots_views)
+            createScreenshots(SUBJECT=subject, SUBJECTS_DIR=subjects_dir, OUTFILE=outfile, INTERACTIVE=False, BASE=screenshots_base, OVERLAY=screenshots_overlay, SURF=screenshots_surf, VIEWS=screenshots_views, SUBJECT_DATA=subjectData)
 
         # ----------------------------------------------------------------------
         # run optional modules: fornix
@@ -891,12 +899,77 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
 
             # store data
             if FORNIX_SHAPE:
-                metricsDict[subject].update(fornixShapeDict[subject])
+                metrics.update(fornixShapeDict[subject])
+                optionalFieldnames.extend(sorted(fornixShapeDict[subject].keys()))
 
         # message
         print("Finished subject", subject, "at", time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(time.time())))
         print("")
 
+    # return
+    return subject, metrics, optionalFieldnames, messages.getvalue()
+
+
+# ------------------------------------------------------------------------------
+# do qatools
+
+def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=False, screenshots_base=["default"], screenshots_overlay=["default"], screenshots_surf=["default"], screenshots_views=["default"], fornix=False, outlier=False, outlier_table=None, fastsurfer=False, jobs=1):
+    """
+    an internal function to run the qatools submodules
+
+    """
+
+    # ------------------------------------------------------------------------------
+    # imports
+
+    import os
+    import csv
+    import functools
+    import concurrent.futures
+
+    from qatoolspython.outlierDetection import outlierTable
+    from qatoolspython.outlierDetection import outlierDetection
+
+    # ------------------------------------------------------------------------------
+    # internal settings (might be turned into command-line arguments in the future)
+
+    OUTLIER_N_MIN = 5
+
+    # --------------------------------------------------------------------------
+    # process
+
+    # start the processing with a message
+    print("")
+    print("-----------------------------")
+
+    # create dict for this subject
+    metricsDict = dict()
+
+    # fieldnames of the optional modules
+    optionalFieldnames = list()
+
+    # process the specified subjects, either one after the other or in
+    # parallel; results are merged in the order of the subjects list
+    doSubject = functools.partial(_do_qatools_subject, subjects_dir=subjects_dir, output_dir=output_dir, shape=shape, screenshots=screenshots, screenshots_base=screenshots_base, screenshots_overlay=screenshots_overlay, screenshots_surf=screenshots_surf, screenshots_views=screenshots_views, fornix=fornix, fastsurfer=fastsurfer, capture=jobs>1)
+
+    if jobs > 1:
+        print("Processing", len(subjects), "subjects with", jobs, "parallel jobs")
+        print("")
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(doSubject, subjects)
+    else:
+        executor = None
+        results = map(doSubject, subjects)
+
+    try:
+        for subject, metrics, fieldnames, messages in results:
+            print(messages, end="")
+            metricsDict.update({ subject : metrics })
+            optionalFieldnames = fieldnames
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
     # --------------------------------------------------------------------------
     # run optional modules: outlier detection
 
@@ -945,11 +1018,7 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
     # we pre-specify the fieldnames because we want to have this particular order
     metricsFieldnames = ['subject','wm_snr_orig','gm_snr_orig','wm_snr_norm','gm_snr_norm','cc_size','holes_lh','holes_rh','defects_lh','defects_rh','topo_lh','topo_rh','con_snr_lh','con_snr_rh','rot_tal_x', 'rot_tal_y', 'rot_tal_z']
 
-    if shape is True:
-        metricsFieldnames.extend(distDict[subject].keys())
-
-    if fornix is True and FORNIX_SHAPE is True:
-        metricsFieldnames.extend(sorted(fornixShapeDict[subject].keys()))
+    metricsFieldnames.extend(optionalFieldnames)
 
     if outlier is True:
         metricsFieldnames.extend(sorted(outlierDict[subject].keys()))
@@ -968,10 +1037,12 @@ def _do_qatools(subjects_dir, output_dir, subjects, shape=False, screenshots=Fal
 # ------------------------------------------------------------------------------
 # run qatools
 
-def run_qatools(subjects_dir, output_dir, subjects=[], shape=False, screenshots=False, screenshots_base="default", screenshots_overlay="default", screenshots_surf="default", screenshots_views="default", fornix=False, outlier=False, outlier_table=None, fastsurfer=False):
+def run_qatools(subjects_dir, output_dir, subjects=[], shape=False, screenshots=False, screenshots_base="default", screenshots_overlay="default", screenshots_surf="default", screenshots_views="default", fornix=False, outlier=False, outlier_table=None, fastsurfer=False, jobs=1):
     """
     a function to run the qatools submodules
 
+    jobs is the number of subjects processed in parallel (default: 1)
+
     """
 
     # ------------------------------------------------------------------------------
@@ -984,4 +1055,4 @@ def run_qatools(subjects_dir, output_dir, subjects=[], shape=False, screenshots=
     _check_packages()
 
     # run qatools
-    _do_qatools(subjects_dir, output_dir, subjects, shape, screenshots, screenshots_base, screenshots_overlay, screenshots_surf, screenshots_views, fornix, outlier, outlier_table, fastsurfer)
+    _do_qatools(subjects_dir, output_dir, subjects, shape, screenshots, screenshots_base, screenshots_overlay, screenshots_surf, screenshots_views, fornix, outlier, outlier_table, fastsurfer, jobs)
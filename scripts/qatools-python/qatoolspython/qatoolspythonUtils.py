@@ -1,6 +1,6 @@
 """
 This module provides various import/export functions as well as the 
-'levelsetsTria' function
+'levelsetsTria' and 'binaryErosion' functions
 
 """
 
@@ -183,3 +183,63 @@ def levelsetsTria(v, t, p, levelsets):
         iLVL.append(n)
 
     return vLVL, lLVL, iLVL
+
+
+# ------------------------------------------------------------------------------
+
+def binaryErosion(mask, size):
+    """
+    A function to erode a binary mask with a cube of a given size.
+
+    The result is identical to skimage.morphology.binary_erosion(mask,
+    np.ones((size, size, size))), i.e. voxels outside of the image are treated
+    as foreground. The erosion is computed on the bounding box of the mask
+    only, on boolean data, and separately along each axis: the erosion with a
+    cube is the same as three successive erosions with a line of the same size.
+
+    Required arguments:
+        - mask : a 3D array, non-zero voxels are foreground
+        - size : the size of the cube
+
+    Returns:
+        - a boolean array of the same shape as mask
+
+    """
+
+    import numpy as np
+
+    mask = np.asarray(mask, dtype=bool)
+    eroded = np.zeros(mask.shape, dtype=bool)
+
+    if not mask.any() or size < 1:
+        eroded[...] = mask
+        return eroded
+
+    # the window of a voxel i along each axis covers i-before ... i+after
+    # (for even sizes, the cube is centered as in scipy / skimage)
+    before = size // 2
+    after = size - 1 - before
+
+    # bounding box of the mask; voxels outside of it are background and stay
+    # background, and the margin makes sure that voxels inside of it are
+    # computed from their full neighborhood
+    box = list()
+    for axis in range(mask.ndim):
+        idx = np.where(np.any(mask, axis=tuple(a for a in range(mask.ndim) if a != axis)))[0]
+        box.append(slice(max(idx[0] - before, 0), min(idx[-1] + after + 1, mask.shape[axis])))
+    box = tuple(box)
+
+    # separable erosion: a voxel stays foreground if all voxels of its window
+    # along the axis are foreground; windows are clipped at the image border
+    crop = mask[box].copy()
+    for axis in range(crop.ndim):
+        view = np.moveaxis(crop, axis, 0)
+        line = np.moveaxis(crop.copy(), axis, 0)
+        for k in range(1, before + 1):
+            view[k:] &= line[:-k]
+        for k in range(1, after + 1):
+            view[:-k] &= line[k:]
+
+    eroded[box] = crop
+
+    return eroded
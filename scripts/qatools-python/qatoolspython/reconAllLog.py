@@ -0,0 +1,225 @@
+"""
+This module provides an incremental reader for recon-all.log files
+
+"""
+
+# -----------------------------------------------------------------------------
+
+def parseReconAllLogLine(line, summary):
+    """
+    A function to parse a single line of a recon-all.log file.
+
+    Recognized lines are turned into events, and the summary of the log is
+    updated accordingly. The first 'defects found' and 'topology fixing
+    took' lines are attributed to the left hemisphere, the following ones to
+    the right hemisphere.
+
+    Required arguments:
+        - line : a line of the log file, without newline
+        - summary : dictionary with the summary of the log so far (see
+          newReconAllLogSummary), updated in place
+
+    Returns:
+        - a list of events, each a dictionary with at least a 'type' key:
+          'invocation', 'step' (name), 'holes' (lh, rh), 'defects' (hemi,
+          count), 'topology_time' (hemi, minutes), 'finished', 'error'
+        - None if the line is recognized but its values cannot be read (e.g.
+          a truncated line); the summary is then left unchanged
+
+    """
+
+    events = list()
+
+    if line.startswith("#@# "):
+        # step header, e.g. "#@# Talairach Sun Oct 18 10:00:00 UTC 2026"
+        words = line[4:].split()
+        days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+        name = " ".join(words[:min([words.index(d) for d in days if d in words], default=len(words))])
+        summary['step'] = name
+        events.append({'type': 'step', 'name': name})
+
+    elif line.startswith("New invocation of recon-all"):
+        summary['finished'] = False
+        summary['error'] = False
+        events.append({'type': 'invocation'})
+
+    elif "orig.nofix lhholes" in line:
+        words = line.split()
+        try:
+            lh_holes, rh_holes = int(words[3].rstrip(",")), int(words[6])
+        except (IndexError, ValueError):
+            return None
+        summary['lh_holes'] = lh_holes
+        summary['rh_holes'] = rh_holes
+        events.append({'type': 'holes', 'lh': summary['lh_holes'], 'rh': summary['rh_holes']})
+
+    elif "defects found" in line:
+        try:
+            count = int(line.split()[0])
+        except (IndexError, ValueError):
+            return None
+        hemi = "lh" if summary['n_defects'] == 0 else "rh"
+        summary['n_defects'] += 1
+        summary[hemi + '_defects'] = count
+        events.append({'type': 'defects', 'hemi': hemi, 'count': summary[hemi + '_defects']})
+
+    elif "topology fixing took" in line:
+        try:
+            minutes = float(line.split()[3])
+        except (IndexError, ValueError):
+            return None
+        hemi = "lh" if summary['n_topo'] == 0 else "rh"
+        summary['n_topo'] += 1
+        summary['topo_time_' + hemi] = minutes
+        events.append({'type': 'topology_time', 'hemi': hemi, 'minutes': summary['topo_time_' + hemi]})
+
+    elif "finished without error" in line:
+        summary['finished'] = True
+        events.append({'type': 'finished'})
+
+    elif "exited with ERRORS" in line:
+        summary['error'] = True
+        events.append({'type': 'error', 'line': line})
+
+    return events
+
+
+# -----------------------------------------------------------------------------
+
+def newReconAllLogSummary():
+    """
+    A function to return an empty summary of a recon-all.log file.
+
+    """
+
+    import numpy as np
+
+    return {
+        'offset': 0, 'inode': None, 'step': None, 'finished': False, 'error': False,
+        'lh_holes': np.nan, 'rh_holes': np.nan, 'lh_defects': np.nan, 'rh_defects': np.nan,
+        'topo_time_lh': np.nan, 'topo_time_rh': np.nan, 'n_defects': 0, 'n_topo': 0,
+        'partial': False
+        }
+
+
+# -----------------------------------------------------------------------------
+
+class ReconAllLogReader:
+    """
+    An incremental reader for recon-all.log files.
+
+    The reader remembers the byte offset reached in each log file, so that
+    subsequent calls to read() only parse lines appended since the previous
+    call. Partial last lines are left for the next call, and malformed lines
+    are skipped. If a file was replaced or truncated, it is parsed again from
+    the start. Offsets and summaries can be persisted to a JSON file.
+
+    Optional arguments:
+        - offsets_file : path to a JSON file where offsets and summaries are
+          loaded from and saved to, default = None
+        - tail : number of bytes to read from the end of log files that were
+          not seen before, default = None (read whole file). Events in the
+          skipped part are not reported, which is useful for monitoring.
+
+    """
+
+    def __init__(self, offsets_file=None, tail=None):
+
+        import os
+        import json
+
+        self.offsets_file = offsets_file
+        self.tail = tail
+        self.summaries = dict()
+
+        if offsets_file is not None and os.path.isfile(offsets_file):
+            try:
+                with open(offsets_file) as f:
+                    self.summaries = json.load(f)
+            except ValueError:
+                self.summaries = dict()
+
+    def read(self, path):
+        """
+        Parses the lines appended to a log file since the previous call.
+
+        Required arguments:
+            - path : path to the recon-all.log file
+
+        Returns:
+            - a list of events (see parseReconAllLogLine)
+
+        Raises FileNotFoundError if the file does not exist.
+
+        """
+
+        import os
+
+        summary = self.summaries.get(path)
+
+        with open(path, 'rb') as logfile:
+
+            stat = os.fstat(logfile.fileno())
+
+            if summary is None or summary['inode'] != stat.st_ino or stat.st_size < summary['offset']:
+                summary = newReconAllLogSummary()
+                summary['inode'] = stat.st_ino
+                if self.tail is not None and stat.st_size > self.tail:
+                    # start at the first complete line within the tail; if the
+                    # tail has none yet, start before the partial line and
+                    # skip it once it is complete
+                    logfile.seek(stat.st_size - self.tail)
+                    if logfile.readline().endswith(b"\n"):
+                        summary['offset'] = logfile.tell()
+                    else:
+                        summary['offset'] = stat.st_size - self.tail
+                        summary['partial'] = True
+                self.summaries[path] = summary
+
+            logfile.seek(summary['offset'])
+            data = logfile.read()
+
+        # skip the rest of a line whose start was not read
+        if summary.get('partial', False):
+            start = data.find(b"\n") + 1
+            if start == 0:
+                return list()
+            summary['offset'] += start
+            summary['partial'] = False
+            data = data[start:]
+
+        # only consume complete lines
+        end = data.rfind(b"\n") + 1
+        summary['offset'] += end
+
+        events = list()
+        for line in data[:end].decode(errors='replace').splitlines():
+            events.extend(parseReconAllLogLine(line, summary) or [])
+
+        return events
+
+    def summary(self, path):
+        """
+        Returns the summary of a log file read so far (step, finished, error,
+        holes, defects and topology fixing times).
+
+        """
+
+        return self.summaries.get(path, newReconAllLogSummary())
+
+    def save(self):
+        """
+        Saves offsets and summaries to the offsets file, if one was given.
+
+        """
+
+        import os
+        import json
+
+        if self.offsets_file is None:
+            return
+
+        tmp = self.offsets_file + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.summaries, f)
+        os.replace(tmp, self.offsets_file)
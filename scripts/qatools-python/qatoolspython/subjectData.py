@@ -0,0 +1,91 @@
+"""
+This module provides a class to load the volumes of a subject only once
+
+"""
+
+# -----------------------------------------------------------------------------
+
+class SubjectData:
+    """
+    A class to load the volumes of a subject only once.
+
+    The checks of a subject (SNR of orig.mgz and norm.mgz, screenshots)
+    read the same volumes. Volumes are loaded on first use, in their native
+    data type (e.g. uint8 for norm.mgz, int32 for aparc+aseg.mgz) instead of
+    float64, and kept in a least recently used cache. The returned arrays are
+    shared between the checks and therefore read-only.
+
+    Required arguments:
+        - subjects_dir : path to the subjects directory
+        - subject : subject ID
+
+    Optional arguments:
+        - max_volumes : maximum number of volumes kept in memory, default = 4
+
+    """
+
+    def __init__(self, subjects_dir, subject, max_volumes=4):
+
+        # imports
+        import collections
+
+        #
+        self.subjects_dir = subjects_dir
+        self.subject = subject
+        self.max_volumes = max_volumes
+        self.images = dict()
+        self.volumes = collections.OrderedDict()
+
+    # -------------------------------------------------------------------------
+
+    def path(self, image):
+        """
+        Returns the path of an image in the mri folder of the subject.
+
+        """
+
+        import os
+
+        return os.path.join(self.subjects_dir, self.subject, "mri", image)
+
+    # -------------------------------------------------------------------------
+
+    def image(self, image):
+        """
+        Returns the nibabel image object (header and data proxy) of an image in
+        the mri folder of the subject, e.g. "norm.mgz".
+
+        Raises FileNotFoundError if the image does not exist.
+
+        """
+
+        import nibabel as nib
+
+        if image not in self.images:
+            self.images[image] = nib.load(self.path(image))
+
+        return self.images[image]
+
+    # -------------------------------------------------------------------------
+
+    def data(self, image):
+        """
+        Returns the data of an image in the mri folder of the subject, e.g.
+        "aseg.mgz", as a read-only array in its native data type.
+
+        Raises FileNotFoundError if the image does not exist.
+
+        """
+
+        import numpy as np
+
+        if image in self.volumes:
+            self.volumes.move_to_end(image)
+        else:
+            volume = np.asanyarray(self.image(image).dataobj)
+            volume.flags.writeable = False
+            self.volumes[image] = volume
+            while len(self.volumes) > self.max_volumes:
+                self.volumes.popitem(last=False)
+
+        return self.volumes[image]
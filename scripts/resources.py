@@ -0,0 +1,223 @@
+"""Resource accounting used by the scheduler to admit jobs.
+
+Each command type has a memory (MB) and thread cost. A job is only started
+when the declared cost of all running jobs plus its own fits in the CPU and
+memory budget, and when the live available memory read from /proc/meminfo
+is large enough for it. When the queue drains, recon-all jobs can be given
+more than one thread with its -openmp flag.
+
+This file can also be imported as a module and contains the following
+functions and classes:
+
+    * read_meminfo - reads /proc/meminfo.
+    * available_memory - returns the live available memory in MB.
+    * read_costs - reads a table of per-command costs.
+    * ResourceBudget - tracks the resources used by running jobs.
+
+"""
+
+import os
+import pandas as pd
+
+# Declared cost per command type: peak memory in MB and number of threads.
+# segmentHA scripts run the MATLAB runtime and need several GB each.
+DEFAULT_COSTS = {
+    "recon-all": {"memory": 2500, "threads": 1},
+    "segmentHA_T1.sh": {"memory": 6000, "threads": 1},
+    "segmentHA_T1_long.sh": {"memory": 8000, "threads": 1},
+    "mri_gcut": {"memory": 1500, "threads": 1},
+    "mri_binarize": {"memory": 500, "threads": 1},
+    "cp": {"memory": 50, "threads": 1},
+    "mask_metrics": {"memory": 500, "threads": 1},
+}
+
+# Cost for commands not listed in the costs table
+UNKNOWN_COST = {"memory": 1000, "threads": 1}
+
+def read_meminfo(path: str = "/proc/meminfo") -> dict:
+    """
+    Reads /proc/meminfo.
+
+    Parameters
+    ----------
+    path : str, default="/proc/meminfo"
+        Path to the meminfo file.
+
+    Returns
+    -------
+    dict
+        Field name to value in MB. Empty if the file is not available.
+
+    """
+
+    meminfo = dict()
+    try:
+        with open(path) as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0]) / 1024
+    except (OSError, ValueError):
+        pass
+    return meminfo
+
+def available_memory() -> float:
+    """
+    Returns the live available memory in MB.
+
+    Returns
+    -------
+    float
+        MemAvailable from /proc/meminfo (MemFree + Buffers + Cached on old
+        kernels), or None if it cannot be read.
+
+    """
+
+    meminfo = read_meminfo()
+    if "MemAvailable" in meminfo:
+        return meminfo["MemAvailable"]
+    if "MemFree" in meminfo:
+        return meminfo["MemFree"] + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0)
+    return None
+
+def read_costs(path: str) -> dict:
+    """
+    Reads a table of per-command costs.
+
+    Parameters
+    ----------
+    path : str
+        Tab separated file. Required columns: command (executable name),
+        memory (peak memory in MB), threads (number of threads).
+
+    Returns
+    -------
+    dict
+        DEFAULT_COSTS updated with the values from the file.
+
+    """
+
+    costs = {command: dict(cost) for command, cost in DEFAULT_COSTS.items()}
+    df = pd.read_csv(path, sep="\t")
+    for row in df.itertuples(index=False):
+        costs[row.command] = {"memory": float(row.memory), "threads": int(row.threads)}
+    return costs
+
+
+class ResourceBudget:
+    """
+    Tracks the resources used by running jobs.
+
+    Parameters
+    ----------
+    cpus : int
+        Number of threads that may run at the same time.
+    memory : float, default=None
+        Memory budget in MB for all running jobs. Defaults to the memory
+        available when the budget is created.
+    costs : dict, default=None
+        Cost per command type, see DEFAULT_COSTS.
+    openmp : int, default=1
+        Maximum number of threads given to a single recon-all job when there
+        are fewer queued jobs than free CPUs.
+    reserve : float, default=1024
+        Memory in MB that must stay available when a job is admitted.
+
+    """
+
+    def __init__(self, cpus: int, memory: float = None, costs: dict = None, openmp: int = 1, reserve: float = 1024):
+        self.cpus = max(1, cpus)
+        self.memory = memory if memory is not None else available_memory()
+        self.costs = costs or DEFAULT_COSTS
+        self.openmp = max(1, openmp)
+        self.reserve = reserve
+        self.used_threads = 0
+        self.used_memory = 0.0
+        self.allocations = dict()
+
+    def cost(self, job: "Job") -> dict:
+        """
+        Returns the declared cost of a job.
+
+        Parameters
+        ----------
+        job : Job
+            Job to evaluate.
+
+        Returns
+        -------
+        dict
+            Memory in MB and number of threads.
+
+        """
+
+        command = os.path.basename(job.argv[0]) if job.argv else None
+        return dict(self.costs.get(command, UNKNOWN_COST))
+
+    def threads_for(self, job: "Job", queued: int) -> int:
+        """
+        Returns the number of threads to give to a job.
+
+        recon-all jobs get up to `openmp` threads when the free CPUs are more
+        than the queued jobs, so a draining queue runs fewer, wider jobs.
+
+        Parameters
+        ----------
+        job : Job
+            Job to evaluate.
+        queued : int
+            Number of jobs ready to run, including this one.
+
+        Returns
+        -------
+        int
+
+        """
+
+        threads = self.cost(job)["threads"]
+        if job.argv[:1] != ["recon-all"] or "-openmp" in job.argv:
+            return threads
+        free = self.cpus - self.used_threads
+        return max(threads, min(self.openmp, free // max(1, queued)))
+
+    def admit(self, job: "Job", threads: int) -> bool:
+        """
+        Checks whether a job fits in the budget.
+
+        Parameters
+        ----------
+        job : Job
+            Job to evaluate.
+        threads : int
+            Number of threads the job will use.
+
+        Returns
+        -------
+        bool
+
+        """
+
+        # Always let one job run, even if it is larger than the budget
+        if not self.allocations:
+            return True
+        memory = self.cost(job)["memory"]
+        if self.used_threads + threads > self.cpus:
+            return False
+        if self.memory is not None and self.used_memory + memory > self.memory:
+            return False
+        available = available_memory()
+        if available is not None and available - memory < self.reserve:
+            return False
+        return True
+
+    def acquire(self, job: "Job", threads: int):
+        """Reserves the resources of a job."""
+        memory = self.cost(job)["memory"]
+        self.allocations[job.name] = (threads, memory)
+        self.used_threads += threads
+        self.used_memory += memory
+
+    def release(self, job: "Job"):
+        """Releases the resources of a finished job."""
+        threads, memory = self.allocations.pop(job.name)
+        self.used_threads -= threads
+        self.used_memory -= memory
@@ -0,0 +1,751 @@
+"""In-process job scheduler used by run.py to drive FreeSurfer commands.
+
+Each job is a command given as an argv list (recon-all, segmentHA_T1.sh,
+mri_gcut, ...) or a short in-process action such as copying files. Jobs may depend on other jobs; a job is dispatched to a
+bounded pool of workers as soon as all of its dependencies are done, and is
+skipped if any of them failed. The exit status, number of attempts and timing
+of every job is kept so it can be written to a machine-readable run report,
+together with its CPU time, peak memory and I/O. The output of each command
+can be captured to its own gzip log instead of the terminal, keeping its
+last lines in memory so they are printed when the job fails.
+Ready jobs are started longest first, using the predicted duration of each
+job plus the longest chain of jobs depending on it. Optionally, a
+ResourceBudget (see resources.py) decides whether the next job fits in the
+free CPUs and memory before it is started.
+
+This file can also be imported as a module and contains the following
+classes and functions:
+
+    * Job - a single command to run for a subject and processing stage.
+    * JobResult - the outcome of a job.
+    * Scheduler - runs jobs over a bounded pool of workers.
+    * read_proc_io - reads the I/O counters of a process.
+    * Watchdog - stops a command that runs for too long or whose log stops growing.
+    * JobOutput - captures the output of a command to a gzip log.
+    * kill_group - sends a signal to the process group of a command.
+    * terminate_all - stops all running commands.
+    * exit_code - converts a wait status to an exit code.
+    * wait_process - waits for a process and records its resource usage.
+    * run_action - runs the in-process action of a job.
+    * run_argv - runs a single command and returns its exit code.
+    * write_report - writes the run report as a JSON file.
+
+"""
+
+import gzip
+import heapq
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Job:
+    """
+    A single command to run for a subject and processing stage.
+
+    Parameters
+    ----------
+    name : str
+        Unique job name. Used as key in the run report.
+    argv : list
+        Command and arguments, e.g. ["recon-all", "-all", "-s", "<id>"].
+    subject : str
+        Subject or unique ID processed by the job.
+    stage : str
+        Processing stage (run.py sub-command, e.g. "recon_all").
+    clean : list, default=None
+        Paths removed before a retry, so the command can start from scratch.
+    deps : list, default=None
+        Names of the jobs that must be done before this job can start.
+    duration : float, default=0
+        Predicted wall time in seconds, used to start the longest jobs first.
+    timeout : float, default=None
+        Wall time limit of an attempt in seconds.
+    stall : float, default=None
+        Seconds without growth of the log file after which an attempt is stopped.
+    log : str, default=None
+        Log file written by the command (e.g. recon-all.log), watched for stalls.
+    action : callable, default=None
+        Function run in-process instead of the command (e.g. copying files),
+        argv then only describes it. The job fails if the function raises
+        an exception.
+
+    """
+
+    def __init__(self, name: str, argv: list, subject: str, stage: str, clean: list = None, deps: list = None, duration: float = 0,
+                 timeout: float = None, stall: float = None, log: str = None, action=None):
+        self.name = name
+        self.argv = argv
+        self.subject = subject
+        self.stage = stage
+        self.clean = clean or []
+        self.deps = deps or []
+        self.duration = duration
+        self.timeout = timeout
+        self.stall = stall
+        self.log = log
+        self.action = action
+
+    def __repr__(self):
+        return f"Job({self.name!r})"
+
+
+class JobResult:
+    """
+    The outcome of a job.
+
+    Parameters
+    ----------
+    job : Job
+        The job that was executed.
+    status : str
+        "done" if the command exited with code 0, "skipped" if a dependency
+        was not done, "failed" otherwise.
+    returncode : int
+        Exit code of the last attempt.
+    attempts : int
+        Number of times the command was started.
+    start : float
+        Epoch time when the first attempt started.
+    end : float
+        Epoch time when the last attempt finished.
+    usage : dict, default=None
+        Resource usage of the last attempt, see wait_process.
+    reason : str, default=None
+        Why the last attempt was stopped by its Watchdog, if it was.
+    log : str, default=None
+        gzip log with the output of all attempts, if it was captured.
+    tail : list, default=None
+        Last output lines of the last attempt of a failed job.
+
+    """
+
+    def __init__(self, job: Job, status: str, returncode: int, attempts: int, start: float, end: float, usage: dict = None, reason: str = None,
+                 log: str = None, tail: list = None):
+        self.job = job
+        self.status = status
+        self.returncode = returncode
+        self.attempts = attempts
+        self.start = start
+        self.end = end
+        self.usage = usage or {}
+        self.reason = reason
+        self.log = log
+        self.tail = tail or []
+
+    @property
+    def wall_time(self) -> float:
+        """Wall time in seconds from the first start to the last end."""
+        return self.end - self.start
+
+    def to_dict(self) -> dict:
+        """Returns the result as a JSON serializable dictionary."""
+        return {
+            "name": self.job.name,
+            "subject": self.job.subject,
+            "stage": self.job.stage,
+            "argv": self.job.argv,
+            "status": self.status,
+            "returncode": self.returncode,
+            "attempts": self.attempts,
+            "start": self.start,
+            "end": self.end,
+            "wall_time": self.wall_time,
+            "reason": self.reason,
+            "log": self.log,
+            "tail": self.tail,
+            **{field: self.usage.get(field) for field in USAGE_FIELDS},
+        }
+
+
+# Fields of the resource usage of a job, max_rss includes the memory of the
+# forked Python parent (see wait_process)
+USAGE_FIELDS = ["user_time", "sys_time", "max_rss", "read_bytes", "write_bytes"]
+
+# Seconds between samples of a running command, doubling from the first to the second value
+USAGE_INTERVAL = (0.1, 5)
+
+
+# Number of output lines of a command kept in memory for error reports
+TAIL_LINES = 20
+
+# Seconds between SIGTERM and SIGKILL when a command is stopped
+KILL_GRACE = 30
+
+# Process groups of the running commands, stopped on KeyboardInterrupt
+_running = set()
+_running_lock = threading.Lock()
+
+
+def _format_duration(seconds: float) -> str:
+    """Formats a limit in whole hours or minutes when possible, e.g. a short limit in seconds."""
+    if seconds >= 3600 and seconds % 3600 == 0:
+        return f"{seconds / 3600:.0f} h"
+    if seconds >= 60 and seconds % 60 == 0:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds:.0f} s"
+
+
+class Watchdog:
+    """
+    Stops a command that runs for too long or whose log stops growing.
+
+    Used as the check function of wait_process.
+
+    Parameters
+    ----------
+    timeout : float, default=None
+        Wall time limit in seconds.
+    stall : float, default=None
+        Seconds without growth of the log file after which the command is stopped.
+    log : str, default=None
+        Log file watched for stalls. A file that does not exist yet counts
+        as not growing.
+
+    """
+
+    def __init__(self, timeout: float = None, stall: float = None, log: str = None):
+        self.timeout = timeout
+        self.stall = stall
+        self.log = log
+        self.reason = None
+        self.start = self.changed = time.time()
+        self.size = None
+
+    def __call__(self) -> bool:
+        """Returns False, and sets reason, if the command must be stopped."""
+        now = time.time()
+        if self.timeout and now - self.start > self.timeout:
+            self.reason = f"timeout after {_format_duration(self.timeout)}"
+            return False
+        if self.stall and self.log:
+            try:
+                size = os.stat(self.log).st_size
+            except OSError:
+                size = None
+            if size != self.size:
+                self.size = size
+                self.changed = now
+            elif now - self.changed > self.stall:
+                self.reason = f"no new lines in {os.path.basename(self.log)} for {_format_duration(self.stall)}"
+                return False
+        return True
+
+
+class JobOutput:
+    """
+    Captures the output of a command to a gzip log.
+
+    stdout and stderr of the command are read line by line by a thread,
+    appended to the log and kept in a ring buffer of the last lines.
+
+    Parameters
+    ----------
+    path : str
+        gzip log file. Every attempt is appended to it, after a header line
+        with the start time and the command.
+    lines : int, default=TAIL_LINES
+        Number of last lines kept in tail.
+
+    """
+
+    def __init__(self, path: str, lines: int = TAIL_LINES):
+        self.path = path
+        self.tail = deque(maxlen=lines)
+        self.thread = None
+
+    def popen_args(self) -> dict:
+        """Returns the subprocess.Popen arguments sending stdout and stderr to a pipe."""
+        return {"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT}
+
+    def start(self, process: subprocess.Popen, argv: list):
+        """
+        Starts reading the output of a process started with popen_args.
+
+        Parameters
+        ----------
+        process : subprocess.Popen
+            The started process.
+        argv : list
+            Command and arguments, written to the header line.
+
+        Returns
+        -------
+        None
+
+        """
+
+        self.tail.clear()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        header = f"# {time.strftime('%Y-%m-%d %H:%M:%S')} {' '.join(argv)}\n".encode()
+        self.thread = threading.Thread(target=self._read, args=(process.stdout, header), daemon=True)
+        self.thread.start()
+
+    def _read(self, stream, header: bytes):
+        with gzip.open(self.path, "ab", compresslevel=6) as f:
+            f.write(header)
+            for line in iter(stream.readline, b""):
+                f.write(line)
+                self.tail.append(line.decode(errors="replace").rstrip())
+        stream.close()
+
+    def join(self):
+        """Waits until the output of the process is read and the log closed."""
+        if self.thread is not None:
+            # Output of children that escaped the process group is not waited for
+            self.thread.join(KILL_GRACE)
+            self.thread = None
+
+
+def kill_group(process: subprocess.Popen, sig: int):
+    """Sends a signal to the process group of a command started with start_new_session."""
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def terminate_all():
+    """Sends SIGTERM to the process groups of all running commands."""
+    with _running_lock:
+        processes = list(_running)
+    for process in processes:
+        kill_group(process, signal.SIGTERM)
+
+
+def read_proc_io(pid: int) -> dict:
+    """
+    Reads the I/O counters of a process from /proc/<pid>/io.
+
+    Parameters
+    ----------
+    pid : int
+        Process ID.
+
+    Returns
+    -------
+    dict
+        Counter name to value (rchar, wchar, read_bytes, write_bytes, ...).
+        Empty if the file cannot be read.
+
+    """
+
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            return {key.strip(): int(value) for key, value in (line.split(":") for line in f if ":" in line)}
+    except (OSError, ValueError):
+        return {}
+
+
+def exit_code(status: int) -> int:
+    """Converts a wait status to an exit code (negative signal number if killed)."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait_process(process: subprocess.Popen, usage: dict = None, check=None) -> int:
+    """
+    Waits for a process and records its resource usage.
+
+    The process is polled with os.waitid, sampling /proc/<pid>/io, and
+    reaped with os.wait4 once it exited, so the counters include all of its
+    children (recon-all runs many short commands).
+
+    Parameters
+    ----------
+    process : subprocess.Popen
+        The started process.
+    usage : dict, default=None
+        Filled with USAGE_FIELDS: user and system CPU time (s), peak resident
+        memory (MB) of the largest process, and bytes read from and written
+        to storage. The peak memory is at least the resident memory of this
+        Python process, which the command is forked from before exec (even
+        for "sh -c true"), so it is only a rough upper bound for small
+        commands; ResourceBudget uses the declared costs instead.
+    check : callable, default=None
+        Called at every sample while the process runs, e.g. a Watchdog. If it
+        returns False, SIGTERM is sent to the process group, followed by
+        SIGKILL after KILL_GRACE seconds.
+
+    Returns
+    -------
+    int
+        Exit code of the process.
+
+    """
+
+    delay = USAGE_INTERVAL[0]
+    io = dict()
+    terminated = None
+    with _running_lock:
+        _running.add(process)
+    try:
+        while True:
+            exited = os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            # Still readable while the process is a zombie
+            io = read_proc_io(process.pid) or io
+            if exited is not None:
+                break
+            if terminated is None and check is not None and not check():
+                terminated = time.time()
+                kill_group(process, signal.SIGTERM)
+            elif terminated is not None and time.time() - terminated > KILL_GRACE:
+                kill_group(process, signal.SIGKILL)
+            time.sleep(delay)
+            delay = min(2 * delay, USAGE_INTERVAL[1])
+    finally:
+        with _running_lock:
+            _running.discard(process)
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    # Orphaned children of the command
+    kill_group(process, signal.SIGKILL)
+    process.returncode = exit_code(status)
+    if usage is not None:
+        usage.update({
+            "user_time": rusage.ru_utime,
+            "sys_time": rusage.ru_stime,
+            "max_rss": rusage.ru_maxrss / 1024,
+            "read_bytes": io.get("read_bytes"),
+            "write_bytes": io.get("write_bytes"),
+        })
+    return process.returncode
+
+
+def run_action(action) -> int:
+    """
+    Runs the in-process action of a job and returns an exit code.
+
+    Parameters
+    ----------
+    action : callable
+        Function without arguments.
+
+    Returns
+    -------
+    int
+        0 if the function returned, 1 if it raised an exception.
+
+    """
+
+    try:
+        action()
+    except Exception as error:
+        print(f"ERROR: {error}")
+        return 1
+    return 0
+
+
+def run_argv(argv: list, env: dict = None, usage: dict = None, check=None, output: JobOutput = None) -> int:
+    """
+    Runs a single command and returns its exit code.
+
+    The command is started in a new session, so it can be stopped together
+    with all of its children.
+
+    Parameters
+    ----------
+    argv : list
+        Command and arguments.
+    env : dict, default=None
+        Environment of the command. If None, the current environment is used.
+    usage : dict, default=None
+        Filled with the resource usage of the command, see wait_process.
+    check : callable, default=None
+        Stops the command when it returns False, see wait_process.
+    output : JobOutput, default=None
+        Captures stdout and stderr of the command. If None, they go to the
+        terminal.
+
+    Returns
+    -------
+    int
+        Exit code of the command, 127 if the executable was not found.
+
+    """
+
+    try:
+        process = subprocess.Popen(argv, env=env, start_new_session=True, **(output.popen_args() if output else {}))
+    except FileNotFoundError:
+        print(f"ERROR: command not found: {argv[0]}")
+        if output is not None:
+            output.tail.append(f"command not found: {argv[0]}")
+        return 127
+    if output is None:
+        return wait_process(process, usage, check)
+    output.start(process, argv)
+    try:
+        return wait_process(process, usage, check)
+    finally:
+        output.join()
+
+
+class Scheduler:
+    """
+    Runs jobs over a bounded pool of workers.
+
+    Parameters
+    ----------
+    parallel : int
+        Maximum number of jobs running at the same time.
+    retries : int, default=0
+        Number of times a failed job is started again.
+    budget : ResourceBudget, default=None
+        CPU and memory budget used to admit jobs. If None, only the number of
+        running jobs is limited.
+    journal : Journal, default=None
+        Journal where every job start and end is recorded.
+    runner : callable, default=None
+        Function called with a Job, a usage dictionary to fill (see
+        wait_process), a Watchdog and a JobOutput (or None), returning the
+        exit code, e.g. WorkQueue.run to run jobs on other nodes. A runner
+        that does not start the command right away also sets "start" and
+        "end" (epoch times) in the usage dictionary, used as the times of the
+        attempt. If None, commands are run locally with run_argv.
+    backoff : float, default=0
+        Seconds to wait before the first retry of a job, doubled for every
+        further retry.
+    logs : str, default=None
+        Directory where the output of each command is captured, to
+        <logs>/<stage>/<name>.log.gz. If None, commands write to the terminal.
+
+    """
+
+    # Seconds between admission checks while jobs wait for free memory
+    ADMISSION_INTERVAL = 30
+
+    def __init__(self, parallel: int, retries: int = 0, budget: "ResourceBudget" = None, journal: "Journal" = None, runner=None, backoff: float = 0,
+                 logs: str = None):
+        self.parallel = max(1, parallel)
+        self.retries = max(0, retries)
+        self.budget = budget
+        self.journal = journal
+        self.runner = runner
+        self.backoff = max(0, backoff)
+        self.logs = logs
+
+    def execute(self, job: Job) -> JobResult:
+        """
+        Runs a job, retrying it on failure according to the retry policy.
+
+        An attempt whose runner raises an exception (e.g. an OSError while
+        staging files) fails with exit code -1.
+
+        Parameters
+        ----------
+        job : Job
+            Job to run.
+
+        Returns
+        -------
+        JobResult
+
+        """
+
+        start = None
+        attempts = 0
+        returncode = None
+        output = None
+        if self.logs and job.action is None:
+            output = JobOutput(os.path.join(self.logs, job.stage, f"{job.name}.log.gz"))
+        while attempts <= self.retries:
+            if attempts > 0:
+                delay = self.backoff * 2 ** (attempts - 1)
+                print(f"Retrying {job.name} in {delay:.0f} s (attempt {attempts + 1} of {self.retries + 1})")
+                time.sleep(delay)
+                for path in job.clean:
+                    shutil.rmtree(path, ignore_errors=True)
+            attempts += 1
+            if self.journal is not None:
+                self.journal.record(job, "running", attempt=attempts)
+            usage = dict()
+            watchdog = Watchdog(job.timeout, job.stall, job.log)
+            if output is not None:
+                # The tail of the result only shows the last attempt
+                output.tail.clear()
+            attempt_start = time.time()
+            try:
+                if job.action is not None:
+                    # In-process actions always run on this node, even with a remote runner
+                    returncode = run_action(job.action)
+                elif self.runner is not None:
+                    returncode = self.runner(job, usage, watchdog, output)
+                else:
+                    returncode = run_argv(job.argv, usage=usage, check=watchdog, output=output)
+            except Exception as error:
+                # e.g. OSError from scratch staging or queue files: a failed attempt, not a failed run
+                print(f"ERROR: {job.name}: {type(error).__name__}: {error}")
+                if output is not None:
+                    output.tail.append(f"{type(error).__name__}: {error}")
+                returncode = -1
+            # A remote runner reports when the command started and finished on
+            # the worker, so the time spent in the queue is not counted
+            attempt_start = usage.pop("start", attempt_start)
+            end = usage.pop("end", time.time())
+            if start is None:
+                start = attempt_start
+            if watchdog.reason:
+                print(f"Stopped {job.name}: {watchdog.reason}")
+            if returncode == 0:
+                break
+        status = "done" if returncode == 0 else "failed"
+        result = JobResult(job, status, returncode, attempts, start, end, usage, watchdog.reason,
+                           output.path if output and os.path.exists(output.path) else None,
+                           list(output.tail) if output and status != "done" else None)
+        if self.journal is not None:
+            self.journal.record(job, status, returncode=returncode, attempts=attempts, wall_time=result.wall_time, reason=watchdog.reason, **usage)
+        return result
+
+    def run(self, jobs: list) -> list:
+        """
+        Runs all jobs and waits for them to finish.
+
+        Jobs whose dependencies are all done are dispatched longest first:
+        by their duration plus the longest chain of jobs depending on them,
+        then in the given order. Dependencies on jobs that are not part of the
+        list are considered to be done already.
+
+        Parameters
+        ----------
+        jobs : list
+            List of Job objects.
+
+        Returns
+        -------
+        list
+            JobResult for each job, in the same order as the input.
+
+        """
+
+        names = {job.name for job in jobs}
+        if len(names) != len(jobs):
+            raise ValueError("Job names must be unique")
+
+        # Number of unfinished dependencies of each job and reverse edges
+        waiting = dict()
+        dependents = {job.name: list() for job in jobs}
+        for job in jobs:
+            deps = [dep for dep in job.deps if dep in names]
+            waiting[job.name] = len(deps)
+            for dep in deps:
+                dependents[dep].append(job)
+
+        # Priority: predicted duration of the job and its longest chain of dependents
+        rank = dict()
+
+        def chain(job, visiting=()):
+            if job.name not in rank:
+                if job.name in visiting:
+                    return 0
+                tail = [chain(dependent, visiting + (job.name,)) for dependent in dependents[job.name]]
+                rank[job.name] = job.duration + max(tail, default=0)
+            return rank[job.name]
+
+        order = {job.name: (-chain(job), index) for index, job in enumerate(jobs)}
+        ready = [(order[job.name], job.name, job) for job in jobs if waiting[job.name] == 0]
+        heapq.heapify(ready)
+
+        running = dict()
+        results = dict()
+
+        def finish(result, started=True):
+            job = result.job
+            results[job.name] = result
+            print(f"[{result.status}] {job.stage} {job.name} "
+                  f"(exit {result.returncode}, {result.wall_time / 60:.1f} min, "
+                  f"{len(results)}/{len(jobs)} finished)")
+            if result.status == "failed":
+                for line in result.tail:
+                    print(f"    {line}")
+                if result.log:
+                    print(f"    full output: {result.log}")
+            if started and self.budget is not None:
+                self.budget.release(job)
+            for dependent in dependents[job.name]:
+                if result.status != "done":
+                    if dependent.name not in results:
+                        now = time.time()
+                        if self.journal is not None:
+                            self.journal.record(dependent, "skipped")
+                        finish(JobResult(dependent, "skipped", None, 0, now, now), started=False)
+                    continue
+                waiting[dependent.name] -= 1
+                if waiting[dependent.name] == 0 and dependent.name not in results:
+                    heapq.heappush(ready, (order[dependent.name], dependent.name, dependent))
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            try:
+                while ready or running:
+                    while ready and len(running) < self.parallel:
+                        _, name, job = ready[0]
+                        if name in results:
+                            heapq.heappop(ready)
+                            continue
+                        if self.budget is not None:
+                            threads = self.budget.threads_for(job, len(ready))
+                            if not self.budget.admit(job, threads):
+                                break
+                            self.budget.acquire(job, threads)
+                            if threads > 1 and job.argv[:1] == ["recon-all"]:
+                                job.argv = job.argv + ["-openmp", str(threads)]
+                        heapq.heappop(ready)
+                        running[executor.submit(self.execute, job)] = job
+                    if not running:
+                        continue
+                    timeout = self.ADMISSION_INTERVAL if ready else None
+                    finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        running.pop(future)
+                        finish(future.result())
+            except KeyboardInterrupt:
+                # Commands run in their own session and do not receive the interrupt
+                terminate_all()
+                raise
+
+        # Jobs in a dependency cycle never become ready
+        for job in jobs:
+            if job.name not in results:
+                now = time.time()
+                results[job.name] = JobResult(job, "skipped", None, 0, now, now)
+
+        return [results[job.name] for job in jobs]
+
+
+def write_report(results: list, path: str):
+    """
+    Writes the run report as a JSON file.
+
+    Parameters
+    ----------
+    results : list
+        List of JobResult objects.
+    path : str
+        Path of the JSON report.
+
+    Returns
+    -------
+    None
+
+    """
+
+    summary = dict()
+    for result in results:
+        summary[result.status] = summary.get(result.status, 0) + 1
+    report = {
+        "summary": summary,
+        "jobs": [result.to_dict() for result in results],
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
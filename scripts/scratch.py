@@ -0,0 +1,183 @@
+"""Node-local scratch staging of recon-all runs.
+
+recon-all writes thousands of small files into its subject folder. With a
+scratch directory, each recon-all [CROSS], [BASE] and [LONG] job runs with
+SUBJECTS_DIR pointing to its own folder in node-local scratch, where the
+subject folders it reads (time points, base) are symlinked from the shared
+SUBJECTS_DIR. When the job finishes, its subject folder is copied next to
+the final location (SUBJECTS_DIR/.<name>.tmp) and renamed into place, so the
+shared SUBJECTS_DIR never holds a partially copied subject.
+
+This file can also be imported as a module and contains the following
+classes:
+
+    * Scratch - runs jobs in a scratch directory and publishes their output.
+
+"""
+
+import os
+import shutil
+
+from scripts.scheduler import JobOutput, Watchdog, run_argv
+
+# Stages whose job creates the subject folder named after the job
+STAGED = ["recon_all", "recon_base", "recon_long"]
+
+
+class Scratch:
+    """
+    Runs jobs in a scratch directory and publishes their output.
+
+    Parameters
+    ----------
+    path : str
+        Node-local scratch directory.
+    subjects_dir : str
+        Shared FreeSurfer SUBJECTS_DIR.
+
+    """
+
+    def __init__(self, path: str, subjects_dir: str):
+        self.path = os.path.abspath(path)
+        self.subjects_dir = os.path.abspath(subjects_dir)
+
+    def staged(self, stage: str) -> bool:
+        """True if jobs of the stage are run in scratch."""
+        return stage in STAGED
+
+    def prepare(self, name: str, argv: list) -> dict:
+        """
+        Creates the scratch SUBJECTS_DIR of a job.
+
+        Subject folders of the shared SUBJECTS_DIR named in the command, and
+        fsaverage, are symlinked into it.
+
+        Parameters
+        ----------
+        name : str
+            Job name, also the name of the subject folder it creates.
+        argv : list
+            Command and arguments.
+
+        Returns
+        -------
+        dict
+            Environment of the command, with SUBJECTS_DIR set to the scratch folder.
+
+        """
+
+        self.clean(name)
+        subjects_dir = os.path.join(self.path, name)
+        os.makedirs(subjects_dir)
+        for folder in set(argv[1:] + ["fsaverage"]):
+            source = os.path.join(self.subjects_dir, folder)
+            if folder != name and os.path.sep not in folder and os.path.isdir(source):
+                os.symlink(source, os.path.join(subjects_dir, folder))
+        return dict(os.environ, SUBJECTS_DIR=subjects_dir)
+
+    def log_path(self, name: str, path: str) -> str:
+        """
+        Returns the scratch location of a file of the shared SUBJECTS_DIR.
+
+        Parameters
+        ----------
+        name : str
+            Job name.
+        path : str
+            Path in the shared SUBJECTS_DIR, e.g. <name>/scripts/recon-all.log.
+
+        Returns
+        -------
+        str
+            Path in the scratch SUBJECTS_DIR of the job. Paths outside
+            SUBJECTS_DIR are returned unchanged.
+
+        """
+
+        path = os.path.abspath(path)
+        if not path.startswith(self.subjects_dir + os.path.sep):
+            return path
+        return os.path.join(self.path, name, os.path.relpath(path, self.subjects_dir))
+
+    def publish(self, name: str):
+        """
+        Moves the subject folder of a job from scratch to SUBJECTS_DIR.
+
+        The folder is copied to SUBJECTS_DIR/.<name>.tmp and renamed into
+        place. An existing SUBJECTS_DIR/<name> is replaced.
+
+        Parameters
+        ----------
+        name : str
+            Job name.
+
+        Returns
+        -------
+        None
+
+        """
+
+        source = os.path.join(self.path, name, name)
+        if not os.path.isdir(source):
+            return
+        tmp = os.path.join(self.subjects_dir, f".{name}.tmp")
+        target = os.path.join(self.subjects_dir, name)
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.copytree(source, tmp, symlinks=True)
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(tmp, target)
+
+    def clean(self, name: str):
+        """
+        Removes the scratch folder of a job and any partial copy in SUBJECTS_DIR.
+
+        Parameters
+        ----------
+        name : str
+            Job name.
+
+        Returns
+        -------
+        None
+
+        """
+
+        shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.subjects_dir, f".{name}.tmp"), ignore_errors=True)
+
+    def run(self, job: "Job", usage: dict = None, watchdog: Watchdog = None, output: JobOutput = None) -> int:
+        """
+        Runs a job, in scratch if its stage is staged.
+
+        The subject folder is published whether the command succeeded or
+        not, so recon-all.error and the logs end up in SUBJECTS_DIR.
+
+        Parameters
+        ----------
+        job : Job
+            Job to run.
+        usage : dict, default=None
+            Filled with the resource usage of the command, see run_argv.
+        watchdog : Watchdog, default=None
+            Stops the command, see run_argv. Its log is moved to scratch.
+        output : JobOutput, default=None
+            Captures the output of the command, see run_argv.
+
+        Returns
+        -------
+        int
+            Exit code of the command.
+
+        """
+
+        if not self.staged(job.stage):
+            return run_argv(job.argv, usage=usage, check=watchdog, output=output)
+        env = self.prepare(job.name, job.argv)
+        if watchdog is not None and watchdog.log:
+            watchdog.log = self.log_path(job.name, watchdog.log)
+        try:
+            returncode = run_argv(job.argv, env, usage, watchdog, output)
+            self.publish(job.name)
+        finally:
+            self.clean(job.name)
+        return returncode
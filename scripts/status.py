@@ -0,0 +1,322 @@
+"""Completion status of every subject in a FreeSurfer SUBJECTS_DIR.
+
+The whole SUBJECTS_DIR is indexed in a single os.scandir traversal: each
+subject folder is classified from the marker files in its scripts folder
+(recon-all.done, recon-all.error, IsRunning.*). The index can be cached to
+a JSON file; a cached entry is reused as long as the modification times of
+the subject and scripts folders did not change, so only subjects that
+changed since the last scan are listed again.
+
+On top of the index, a status report gives the counts per stage, the current
+recon-all step of each running subject, elapsed time and ETA. Logs are read
+with the incremental ReconAllLogReader of the bundled qatools-python package:
+a log seen for the first time is only read from its last TAIL_BYTES bytes,
+and later refreshes only parse the lines appended since.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * subject_status - classifies a single subject folder.
+    * scan_subjects_dir - builds the status index of a SUBJECTS_DIR.
+    * get_state - returns the state of a subject from the index.
+    * expected_subjects - lists the subject folders expected from an input file.
+    * status_report - builds the status report of a SUBJECTS_DIR.
+    * print_status - prints a status report.
+
+"""
+
+import json
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "qatools-python"))
+from qatoolspython.reconAllLog import ReconAllLogReader
+
+# States of a subject folder. "incomplete" folders have no marker file,
+# subjects without a folder are "missing".
+STATES = ["done", "error", "running", "incomplete", "missing"]
+
+# Stages reported by status_report
+STAGES = ["recon_all", "recon_base", "recon_long"]
+
+# Number of bytes read from the end of a recon-all.log seen for the first time
+TAIL_BYTES = 65536
+
+# Folders in SUBJECTS_DIR that are not subjects
+IGNORE = {"fsaverage", "lh.EC_average", "rh.EC_average"}
+
+def subject_status(subject_path: str) -> dict:
+    """
+    Classifies a single subject folder.
+
+    Parameters
+    ----------
+    subject_path : str
+        Path to the subject folder.
+
+    Returns
+    -------
+    dict
+        state: "running" if an IsRunning file exists, else "error" if a
+        *.error file exists, else "done" if a *.done file exists, else
+        "incomplete"; stage: "recon_long" for <tp>.long.<base> folders,
+        "recon_base" for folders with a base-tps file, "recon_all" otherwise.
+
+    """
+
+    done = error = running = False
+    try:
+        with os.scandir(os.path.join(subject_path, "scripts")) as entries:
+            for entry in entries:
+                if entry.name.startswith("IsRunning"):
+                    running = True
+                elif entry.name.endswith(".error"):
+                    error = True
+                elif entry.name.endswith(".done"):
+                    done = True
+    except OSError:
+        pass
+
+    if running:
+        state = "running"
+    elif error:
+        state = "error"
+    elif done:
+        state = "done"
+    else:
+        state = "incomplete"
+
+    name = os.path.basename(os.path.normpath(subject_path))
+    if ".long." in name:
+        stage = "recon_long"
+    elif os.path.isfile(os.path.join(subject_path, "base-tps")):
+        stage = "recon_base"
+    else:
+        stage = "recon_all"
+
+    return {"state": state, "stage": stage}
+
+def _mtimes(subject_path: str) -> list:
+    """Modification times (ns) of a subject folder and its scripts folder."""
+    mtimes = list()
+    for path in (subject_path, os.path.join(subject_path, "scripts")):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+def scan_subjects_dir(subjects_dir: str, cache: str = None) -> dict:
+    """
+    Builds the status index of a SUBJECTS_DIR.
+
+    Parameters
+    ----------
+    subjects_dir : str
+        FreeSurfer SUBJECTS_DIR.
+    cache : str, default=None
+        Path to a JSON index file. Entries whose folder modification times
+        did not change are taken from it, and the file is updated.
+
+    Returns
+    -------
+    dict
+        Subject folder name to {"state", "stage"}, see subject_status.
+
+    """
+
+    cached = dict()
+    if cache and os.path.isfile(cache):
+        try:
+            with open(cache) as f:
+                cached = json.load(f)
+        except ValueError:
+            cached = dict()
+
+    index = dict()
+    entries_cache = dict()
+    with os.scandir(subjects_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name in IGNORE or not entry.is_dir():
+                continue
+            mtimes = _mtimes(entry.path)
+            previous = cached.get(entry.name)
+            if previous is not None and previous["mtimes"] == mtimes:
+                status = {"state": previous["state"], "stage": previous["stage"]}
+            else:
+                status = subject_status(entry.path)
+            index[entry.name] = status
+            entries_cache[entry.name] = dict(status, mtimes=mtimes)
+
+    if cache:
+        tmp = f"{cache}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entries_cache, f)
+        os.replace(tmp, cache)
+
+    return index
+
+def get_state(index: dict, name: str) -> str:
+    """
+    Returns the state of a subject from the index.
+
+    Parameters
+    ----------
+    index : dict
+        Output of scan_subjects_dir.
+    name : str
+        Subject folder name.
+
+    Returns
+    -------
+    str
+        One of STATES.
+
+    """
+
+    return index.get(name, {}).get("state", "missing")
+
+def expected_subjects(recon_input: str) -> dict:
+    """
+    Lists the subject folders expected from an input file.
+
+    Parameters
+    ----------
+    recon_input : str
+        Path to recon_all_input.txt. The subject column is optional; if
+        present, base and long folders are expected as well.
+
+    Returns
+    -------
+    dict
+        Stage to list of subject folder names.
+
+    """
+
+    df = pd.read_csv(recon_input, sep="\t", dtype=str)
+    expected = {"recon_all": list(df["id"])}
+    if "subject" in df:
+        expected["recon_base"] = list(df["subject"].unique())
+        expected["recon_long"] = [f"{id}.long.{subject}" for id, subject in zip(df["id"], df["subject"])]
+    return expected
+
+def status_report(subjects_dir: str, recon_input: str = None, cache: str = None, model: "RuntimeModel" = None, reader: ReconAllLogReader = None) -> dict:
+    """
+    Builds the status report of a SUBJECTS_DIR.
+
+    Parameters
+    ----------
+    subjects_dir : str
+        FreeSurfer SUBJECTS_DIR.
+    recon_input : str, default=None
+        Path to recon_all_input.txt. Expected subjects without a folder are
+        reported as queued.
+    cache : str, default=None
+        JSON index cache, see scan_subjects_dir.
+    model : RuntimeModel, default=None
+        Runtime model used to estimate the remaining time of running subjects.
+    reader : ReconAllLogReader, default=None
+        Log reader kept between refreshes. If None, a new reader starting at
+        the last TAIL_BYTES bytes of each log is used.
+
+    Returns
+    -------
+    dict
+        "stages": stage to state to sorted list of subject folder names,
+        "running": list of dicts with subject, stage, step, elapsed and
+        remaining seconds (None without a model), "time": scan time.
+
+    """
+
+    now = time.time()
+    if reader is None:
+        reader = ReconAllLogReader(tail=TAIL_BYTES)
+    index = scan_subjects_dir(subjects_dir, cache)
+    stages = {stage: {state: list() for state in ["done", "error", "running", "incomplete", "queued"]} for stage in STAGES}
+
+    for name, status in index.items():
+        stages[status["stage"]][status["state"]].append(name)
+
+    if recon_input:
+        for stage, names in expected_subjects(recon_input).items():
+            stages[stage]["queued"].extend(name for name in names if name not in index)
+
+    running = list()
+    for stage in STAGES:
+        for names in stages[stage].values():
+            names.sort()
+        for name in stages[stage]["running"]:
+            scripts = os.path.join(subjects_dir, name, "scripts")
+            try:
+                with os.scandir(scripts) as entries:
+                    started = min((entry.stat().st_mtime for entry in entries if entry.name.startswith("IsRunning")), default=now)
+            except FileNotFoundError:
+                # Subject folder removed, or run finished, since the index scan
+                continue
+            elapsed = now - started
+            remaining = None
+            if model is not None:
+                remaining = max(0.0, model.predict(stage) - elapsed)
+            log = os.path.join(scripts, "recon-all.log")
+            try:
+                reader.read(log)
+            except OSError:
+                pass
+            running.append({"subject": name, "stage": stage, "step": reader.summary(log)["step"],
+                            "elapsed": elapsed, "remaining": remaining})
+
+    return {"stages": stages, "running": running, "time": now}
+
+def _hours(seconds: float) -> str:
+    """Formats seconds as hours:minutes."""
+    if seconds is None:
+        return "-"
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}:{minutes % 60:02d}"
+
+def print_status(report: dict, parallel: int = None, verbose: bool = False):
+    """
+    Prints a status report.
+
+    Parameters
+    ----------
+    report : dict
+        Output of status_report.
+    parallel : int, default=None
+        Number of parallel runs, used for the overall ETA. Defaults to the
+        number of running subjects.
+    verbose : bool, default=False
+        Also list the subjects in each state.
+
+    Returns
+    -------
+    None
+
+    """
+
+    print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(report["time"])))
+    print(f"{'stage':<12}{'done':>8}{'error':>8}{'running':>9}{'incomplete':>12}{'queued':>8}")
+    for stage, states in report["stages"].items():
+        print(f"{stage:<12}{len(states['done']):>8}{len(states['error']):>8}{len(states['running']):>9}"
+              f"{len(states['incomplete']):>12}{len(states['queued']):>8}")
+        if verbose:
+            for state, names in states.items():
+                if names:
+                    print(f"  {state}: {' '.join(names)}")
+
+    if report["running"]:
+        print("")
+        print(f"{'running':<40}{'step':<32}{'elapsed':>9}{'ETA':>9}")
+        for job in sorted(report["running"], key=lambda job: -job["elapsed"]):
+            print(f"{job['subject']:<40}{(job['step'] or '-'):<32}{_hours(job['elapsed']):>9}{_hours(job['remaining']):>9}")
+
+    remaining = [job["remaining"] for job in report["running"] if job["remaining"] is not None]
+    if remaining:
+        workers = parallel or len(report["running"])
+        queued = sum(len(states["queued"]) + len(states["incomplete"]) for states in report["stages"].values())
+        mean = sum(job["elapsed"] + job["remaining"] for job in report["running"]) / len(report["running"])
+        eta = (sum(remaining) + queued * mean) / max(1, workers)
+        print("")
+        print(f"Estimated time to finish: {_hours(eta)} (h:mm)")
@@ -11,11 +11,16 @@ functions:
 """
 
 import sys
+import os
 import argparse
-from glob import glob
+import shlex
 import pandas as pd
 from datetime import date
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.manifest import is_manifest, read_manifest, read_tasks, task_argv, task_name, write_manifest
+from scripts.status import get_state, scan_subjects_dir
+
 def argument_parser(args: list) -> "ArgumentParser.parse_args":
     """
     Parser for command-line options, arguments and sub-commands.
@@ -32,21 +37,23 @@ def argument_parser(args: list) -> "ArgumentParser.parse_args":
     """
 
     parser = argparse.ArgumentParser(description="Create a new recon_input file after a PC failure (power, restart, ...)")
+    parser.add_argument('-s', '--subjects_dir', type=str, help='FreeSurfer SUBJECTS_DIR (default: FS_OUTPUTS).', default='FS_OUTPUTS')
+    parser.add_argument('--cache', type=str, help='JSON file caching the status of each subject folder between runs.', default=None)
     subparsers = parser.add_subparsers(dest="command")
 
     all = subparsers.add_parser('all', help='Update input for recon-all [CROSS].')
     all.add_argument('-i', '--input', type=str, help='recon_all_input.txt file used for cross processing.', required=True)
     
     base = subparsers.add_parser('base', help='Update input for recon-all [BASE].')
-    base.add_argument('-i', '--input', type=str, help='recon_base_input.txt file used for base processing.', required=True)
+    base.add_argument('-i', '--input', type=str, help='recon_base_input.txt or manifest file used for base processing.', required=True)
     
     long = subparsers.add_parser('long', help='Update input for recon-all [LONG].')
-    long.add_argument('-i', '--input', type=str, help='recon_long_input.txt file used for long processing.', required=True)
+    long.add_argument('-i', '--input', type=str, help='recon_long_input.txt or manifest file used for long processing.', required=True)
     
     return parser.parse_args()
 
 
-def update_recon_all_input(recon_input: str):
+def update_recon_all_input(recon_input: str, subjects_dir: str = "FS_OUTPUTS", cache: str = None):
     """
     Updates the recon_all_input.txt file to remove successfully processed data.
 
@@ -54,6 +61,10 @@ def update_recon_all_input(recon_input: str):
     ----------
     recon_input : str
         Path to recon_all_input.txt file used for cross processing.
+    subjects_dir : str, default="FS_OUTPUTS"
+        FreeSurfer SUBJECTS_DIR.
+    cache : str, default=None
+        JSON file caching the status index of subjects_dir.
 
     Returns
     -------
@@ -62,25 +73,30 @@ def update_recon_all_input(recon_input: str):
     """
     
     original_input = pd.read_csv(recon_input, sep='\t')
-    not_done = list()
-    for id in original_input['id']:
-        done = glob(f"FS_OUTPUTS/{id}/scripts/*.done")
-        if len(done) == 0:
-            not_done.append(id)
-    
-    not_done = original_input[original_input['id'].isin(not_done)]
+    index = scan_subjects_dir(subjects_dir, cache)
+    done = original_input['id'].astype(str).map(lambda id: get_state(index, id) == "done")
+    not_done = original_input[~done]
     date_today = date.today().strftime("%Y-%m-%d")
     not_done.to_csv(f"{date_today}_{recon_input}", sep="\t", index=False, header=True)
 
-def update_recon_base_long_input(recon_input: str, long=False):
+def update_recon_base_long_input(recon_input: str, long=False, subjects_dir: str = "FS_OUTPUTS", cache: str = None):
 
     """
     Updates the recon_base_input.txt or recon_long_input.txt file to remove successfully processed data.
 
+    Manifests (see scripts/manifest.py) are updated as a whole: done tasks
+    of every stage are removed.
+
     Parameters
     ----------
     recon_input : str
-        Path to recon_base_input.txt or recon_long_input.txt file used for base or long processing.
+        Path to recon_base_input.txt, recon_long_input.txt or manifest file used for base or long processing.
+    long : bool, default=False
+        True for recon_long_input.txt.
+    subjects_dir : str, default="FS_OUTPUTS"
+        FreeSurfer SUBJECTS_DIR.
+    cache : str, default=None
+        JSON file caching the status index of subjects_dir.
 
     Returns
     -------
@@ -88,26 +104,27 @@ def update_recon_base_long_input(recon_input: str, long=False):
 
     """
     
-    not_done = list()
-    with open(recon_input) as f:
-        lines = f.readlines()
-        for line in lines:
-            subject = line.split(" ")[2]
-            if long:
-                done = glob(f"FS_OUTPUTS/{subject}.long.*/scripts/*.done")
-            else:
-                done = glob(f"FS_OUTPUTS/{subject}/scripts/*.done")
-            if len(done) == 0:
-                not_done.append(line)
+    index = scan_subjects_dir(subjects_dir, cache)
+    manifest = is_manifest(recon_input)
+    if manifest:
+        tasks = read_manifest(recon_input)
+    else:
+        tasks = read_tasks(recon_input, "recon_long" if long else "recon_base")
+    done = pd.Series([get_state(index, task_name(task)) == "done" for task in tasks.to_dict(orient='records')], index=tasks.index, dtype=bool)
+    not_done = tasks[~done]
     
     date_today = date.today().strftime("%Y-%m-%d")
-    with open(f"{date_today}_{recon_input}",'w') as f:
-        for cmd in not_done:
-            f.write(cmd)
+    output = f"{date_today}_{recon_input}"
+    if manifest:
+        write_manifest(not_done, output)
+    else:
+        with open(output, 'w') as f:
+            for task in not_done.to_dict(orient='records'):
+                f.write(" ".join(shlex.quote(arg) for arg in task_argv(task)) + "\n")
     
 if __name__ == '__main__':
     args = argument_parser(sys.argv[1:])
     if args.command == 'all':
-        update_recon_all_input(args.input)
+        update_recon_all_input(args.input, args.subjects_dir, args.cache)
     if (args.command == 'base') or (args.command == 'long'):
-        update_recon_base_long_input(args.input)
\ No newline at end of file
+        update_recon_base_long_input(args.input, args.command == 'long', args.subjects_dir, args.cache)
\ No newline at end of file
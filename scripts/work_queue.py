@@ -0,0 +1,479 @@
+"""Work queue on a shared filesystem used to run jobs on several nodes.
+
+The coordinator (run.py with --queue) and the workers (run.py worker) share
+a queue directory, e.g. next to SUBJECTS_DIR on the shared filesystem. Each
+job is a JSON file that moves through the sub-folders:
+
+    * pending - submitted by the coordinator, waiting for a worker.
+    * claimed - taken by a worker (atomic os.rename), which touches the file
+      every HEARTBEAT_INTERVAL seconds while the job is running.
+    * results - exit code written by the worker, read and removed by the
+      coordinator.
+
+If a claimed file is not touched for longer than the lease, the worker is
+considered lost and the attempt is reported to the coordinator as failed, so
+the Scheduler retry policy applies (clean paths removed, counted against the
+retries); a worker that finds its claimed file gone stops its command. Every
+change of state is done while holding an fcntl lock on the queue lock file.
+
+This file can also be imported as a module and contains the following
+classes and functions:
+
+    * WorkQueue - file based queue of jobs shared by a coordinator and workers.
+    * run_worker - claims and runs jobs from a queue.
+
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from scripts.scheduler import JobOutput, Watchdog, kill_group, wait_process
+
+FOLDERS = ["pending", "claimed", "results"]
+
+
+class WorkQueue:
+    """
+    File based queue of jobs shared by a coordinator and workers.
+
+    Parameters
+    ----------
+    path : str
+        Queue directory, on a filesystem shared by all nodes.
+    lease : float, default=600
+        Seconds without heartbeat after which the attempt of a claimed job
+        fails.
+
+    """
+
+    # Seconds between checks for new jobs or results
+    POLL_INTERVAL = 5
+
+    # Seconds between heartbeats of a running job
+    HEARTBEAT_INTERVAL = 30
+
+    def __init__(self, path: str, lease: float = 600):
+        self.path = path
+        self.lease = lease
+        # fcntl locks are held per process, threads also need a local lock
+        self.thread_lock = threading.Lock()
+        # Names of the jobs submitted by this coordinator, later submissions are retries
+        self.submitted = set()
+        for folder in FOLDERS:
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    def _file(self, folder: str, name: str) -> str:
+        return os.path.join(self.path, folder, f"{name}.json")
+
+    def _write(self, path: str, data: dict):
+        # Hidden temporary file in the same folder, so pending jobs are never seen half written
+        tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @contextmanager
+    def lock(self):
+        """Holds the queue lock (fcntl, works across nodes on NFS)."""
+        with self.thread_lock, open(os.path.join(self.path, "lock"), "a") as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def stopped(self) -> bool:
+        """True if a "stop" file was created in the queue directory."""
+        return os.path.exists(os.path.join(self.path, "stop"))
+
+    def clear(self) -> list:
+        """
+        Removes the jobs left in the queue by a previous coordinator.
+
+        Used when resuming: the pending jobs and results are stale, and the
+        worker of a claimed job stops its command when it finds its claimed
+        file gone. Claimed jobs are marked as submitted, so their next
+        submission is a retry and the worker removes their clean paths
+        first, in case the old worker wrote to them before it stopped.
+
+        Returns
+        -------
+        list
+            Names of the jobs that were claimed by a worker.
+
+        """
+
+        claimed = list()
+        with self.lock():
+            for folder in FOLDERS:
+                with os.scandir(os.path.join(self.path, folder)) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith(".json"):
+                            continue
+                        if folder == "claimed":
+                            claimed.append(entry.name[:-len(".json")])
+                        os.remove(entry.path)
+        self.submitted.update(claimed)
+        return claimed
+
+    def submit(self, job: "Job", output: str = None):
+        """
+        Adds a job to the pending jobs.
+
+        Parameters
+        ----------
+        job : Job
+            Job to submit. Its name, argv, subject, stage, timeout, stall,
+            log and clean paths are sent. The worker removes the clean paths
+            before running a retry, in case a lost worker wrote to them after
+            the coordinator removed them.
+        output : str, default=None
+            gzip log where the worker captures the output of the command.
+
+        Returns
+        -------
+        None
+
+        """
+
+        task = {"name": job.name, "argv": job.argv, "subject": job.subject, "stage": job.stage,
+                "timeout": job.timeout, "stall": job.stall, "log": job.log, "output": output,
+                "clean": job.clean, "retry": job.name in self.submitted, "submitted": time.time()}
+        self.submitted.add(job.name)
+        with self.lock():
+            try:
+                os.remove(self._file("results", job.name))
+            except FileNotFoundError:
+                pass
+            self._write(self._file("pending", job.name), task)
+
+    def result(self, name: str) -> dict:
+        """
+        Returns and removes the result of a job.
+
+        Parameters
+        ----------
+        name : str
+            Job name.
+
+        Returns
+        -------
+        dict
+            Task with returncode and worker, or None if the job is not finished.
+
+        """
+
+        path = self._file("results", name)
+        with self.lock():
+            if not os.path.isfile(path):
+                return None
+            with open(path) as f:
+                result = json.load(f)
+            os.remove(path)
+        return result
+
+    def expire(self, name: str) -> bool:
+        """
+        Fails the attempt of a claimed job if its lease expired.
+
+        The claimed file is replaced by a result with exit code -1, so the
+        coordinator handles it as any failed attempt. The lost worker stops
+        its command when it finds its claimed file gone.
+
+        Parameters
+        ----------
+        name : str
+            Job name.
+
+        Returns
+        -------
+        bool
+            True if the attempt was failed.
+
+        """
+
+        claimed = self._file("claimed", name)
+        with self.lock():
+            try:
+                age = time.time() - os.stat(claimed).st_mtime
+                with open(claimed) as f:
+                    task = json.load(f)
+            except FileNotFoundError:
+                return False
+            if age <= self.lease:
+                return False
+            reason = f"lease expired ({age:.0f} s without heartbeat from {task.get('worker')})"
+            self._write(self._file("results", name), dict(task, returncode=-1, usage={}, reason=reason, tail=[], finished=time.time()))
+            os.remove(claimed)
+        print(f"WARNING: {name}: {reason}, attempt failed")
+        return True
+
+    def run(self, job: "Job", usage: dict = None, watchdog: "Watchdog" = None, output: JobOutput = None) -> int:
+        """
+        Submits a job and waits for a worker to run it.
+
+        Used by the coordinator as the Scheduler runner instead of running
+        the command locally.
+
+        Parameters
+        ----------
+        job : Job
+            Job to run.
+        usage : dict, default=None
+            Filled with the resource usage measured by the worker, and with
+            start and end: when the worker claimed the job and finished it,
+            so the wait in the queue is not part of its wall time.
+        watchdog : Watchdog, default=None
+            Its timeout, stall and log are enforced by the worker, and its
+            reason is set from the result.
+        output : JobOutput, default=None
+            The worker captures the output of the command to its path, which
+            must be on the shared filesystem, and its tail is set from the result.
+
+        Returns
+        -------
+        int
+            Exit code of the command on the worker.
+
+        """
+
+        self.submit(job, os.path.abspath(output.path) if output else None)
+        while True:
+            result = self.result(job.name)
+            if result is not None:
+                if usage is not None:
+                    usage.update(result.get("usage", {}))
+                    usage.update({"start": result.get("claimed", result["submitted"]), "end": result["finished"]})
+                if watchdog is not None:
+                    watchdog.reason = result.get("reason")
+                if output is not None:
+                    output.tail.clear()
+                    output.tail.extend(result.get("tail", []))
+                return result["returncode"]
+            if not self.expire(job.name):
+                time.sleep(self.POLL_INTERVAL)
+
+    def claim(self, worker: str) -> dict:
+        """
+        Claims the oldest pending job.
+
+        Parameters
+        ----------
+        worker : str
+            Worker identifier stored with the job.
+
+        Returns
+        -------
+        dict
+            The claimed task, or None if no job is pending.
+
+        """
+
+        pending = os.path.join(self.path, "pending")
+        with self.lock():
+            entries = [entry for entry in os.scandir(pending) if entry.name.endswith(".json") and not entry.name.startswith(".")]
+            for entry in sorted(entries, key=lambda entry: (entry.stat().st_mtime, entry.name)):
+                claimed = os.path.join(self.path, "claimed", entry.name)
+                try:
+                    os.rename(entry.path, claimed)
+                except FileNotFoundError:
+                    continue
+                with open(claimed) as f:
+                    task = json.load(f)
+                task["worker"] = worker
+                task["claimed"] = time.time()
+                self._write(claimed, task)
+                return task
+        return None
+
+    def _owns(self, task: dict) -> bool:
+        # The claimed file may belong to a retry of the job claimed by another worker
+        try:
+            with open(self._file("claimed", task["name"])) as f:
+                claimed = json.load(f)
+        except FileNotFoundError:
+            return False
+        return claimed.get("worker") == task["worker"] and claimed.get("claimed") == task["claimed"]
+
+    def heartbeat(self, task: dict) -> bool:
+        """
+        Renews the lease of a claimed job.
+
+        Parameters
+        ----------
+        task : dict
+            The claimed task.
+
+        Returns
+        -------
+        bool
+            False if the job is no longer claimed by this worker (lease expired).
+
+        """
+
+        with self.lock():
+            if not self._owns(task):
+                return False
+            os.utime(self._file("claimed", task["name"]))
+        return True
+
+    def complete(self, task: dict, returncode: int, usage: dict = None, reason: str = None, tail: list = None) -> bool:
+        """
+        Reports the exit code of a claimed job.
+
+        Parameters
+        ----------
+        task : dict
+            The claimed task.
+        returncode : int
+            Exit code of the command.
+        usage : dict, default=None
+            Resource usage of the command.
+        reason : str, default=None
+            Why the command was stopped by its Watchdog, if it was.
+        tail : list, default=None
+            Last output lines of the command.
+
+        Returns
+        -------
+        bool
+            False if the job is no longer claimed by this worker (lease
+            expired), in which case the result is dropped.
+
+        """
+
+        claimed = self._file("claimed", task["name"])
+        with self.lock():
+            if not self._owns(task):
+                return False
+            self._write(self._file("results", task["name"]), dict(task, returncode=returncode, usage=usage or {}, reason=reason, tail=tail or [], finished=time.time()))
+            os.remove(claimed)
+        return True
+
+
+def _run_task(queue: WorkQueue, worker: str, task: dict, scratch: "Scratch" = None):
+    """Runs a claimed job and reports its exit code."""
+    if task.get("retry"):
+        # Partial output of a previous attempt, possibly from a lost worker
+        for path in task.get("clean", []):
+            shutil.rmtree(path, ignore_errors=True)
+    staged = scratch is not None and scratch.staged(task["stage"])
+    process = None
+    try:
+        env = scratch.prepare(task["name"], task["argv"]) if staged else None
+        watchdog = Watchdog(task.get("timeout"), task.get("stall"), task.get("log"))
+        if staged and watchdog.log:
+            watchdog.log = scratch.log_path(task["name"], watchdog.log)
+        output = JobOutput(task["output"]) if task.get("output") else None
+        try:
+            process = subprocess.Popen(task["argv"], env=env, start_new_session=True, **(output.popen_args() if output else {}))
+        except FileNotFoundError:
+            print(f"ERROR: command not found: {task['argv'][0]}")
+            if staged:
+                scratch.clean(task["name"])
+            queue.complete(task, 127, tail=[f"command not found: {task['argv'][0]}"])
+            return
+
+        # Renew the lease at most every HEARTBEAT_INTERVAL seconds
+        beats = {"last": time.time(), "lost": False}
+
+        def heartbeat():
+            if time.time() - beats["last"] >= queue.HEARTBEAT_INTERVAL:
+                beats["last"] = time.time()
+                try:
+                    beats["lost"] = not queue.heartbeat(task)
+                except OSError as error:
+                    # Retried at the next interval, the lease covers short outages
+                    print(f"WARNING: [{worker}] heartbeat of {task['name']} failed: {error}")
+            return not beats["lost"] and watchdog()
+
+        usage = dict()
+        if output is not None:
+            output.start(process, task["argv"])
+        try:
+            returncode = wait_process(process, usage, heartbeat)
+        finally:
+            if output is not None:
+                output.join()
+        if watchdog.reason:
+            print(f"[{worker}] stopped {task['name']}: {watchdog.reason}")
+        lost = beats["lost"]
+
+        if staged:
+            if not lost:
+                scratch.publish(task["name"])
+            scratch.clean(task["name"])
+        if lost:
+            print(f"[{worker}] lease of {task['name']} lost, job stopped")
+        elif queue.complete(task, returncode, usage, watchdog.reason, list(output.tail) if output else None):
+            print(f"[{worker}] finished {task['name']} (exit {returncode})")
+    except Exception as error:
+        reason = f"worker error: {error!r}"
+        print(f"ERROR: [{worker}] {task['name']}: {reason}")
+        if process is not None and process.returncode is None:
+            kill_group(process, signal.SIGKILL)
+            process.wait()
+        if staged:
+            scratch.clean(task["name"])
+        try:
+            queue.complete(task, -1, reason=reason, tail=[reason])
+        except OSError as error:
+            # The attempt is failed by the coordinator once the lease expires
+            print(f"ERROR: [{worker}] could not report {task['name']}: {error}")
+
+
+def _work(queue: WorkQueue, worker: str, idle: float = None, scratch: "Scratch" = None):
+    """Claims and runs jobs until the queue is stopped or idle for too long."""
+    last = time.time()
+    while not queue.stopped():
+        task = queue.claim(worker)
+        if task is None:
+            if idle and time.time() - last > idle:
+                return
+            time.sleep(queue.POLL_INTERVAL)
+            continue
+
+        print(f"[{worker}] running {task['name']}")
+        _run_task(queue, worker, task, scratch)
+        last = time.time()
+
+
+def run_worker(path: str, parallel: int = 1, idle: float = None, scratch: "Scratch" = None):
+    """
+    Claims and runs jobs from a queue.
+
+    Parameters
+    ----------
+    path : str
+        Queue directory.
+    parallel : int, default=1
+        Number of jobs run at the same time by this worker.
+    idle : float, default=None
+        Stop after this many seconds without a pending job. If None, run
+        until a "stop" file is created in the queue directory.
+    scratch : Scratch, default=None
+        Node-local scratch where recon-all jobs are run (see scratch.py).
+
+    Returns
+    -------
+    None
+
+    """
+
+    queue = WorkQueue(path)
+    host = f"{socket.gethostname()}:{os.getpid()}"
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        slots = [executor.submit(_work, queue, f"{host}:{slot}", idle, scratch) for slot in range(max(1, parallel))]
+        # Report a failed slot as soon as it stops, the others keep running
+        for slot in as_completed(slots):
+            if slot.exception() is not None:
+                print(f"ERROR: worker slot stopped: {slot.exception()!r}")